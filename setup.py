@@ -14,14 +14,13 @@ setup(name='repoze.filesafe',
       classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         ],
       keywords='transaction wsgi repoze',
       author="Wichert Akkerman",
@@ -33,13 +32,22 @@ setup(name='repoze.filesafe',
       include_package_data=True,
       namespace_packages=['repoze'],
       zip_safe=False,
-      install_requires=['transaction', 'six'],
+      python_requires='>=3.7',
+      install_requires=['transaction >= 1.6.0'],
       test_suite = "repoze.filesafe",
       entry_points="""
+      [console_scripts]
+      filesafe-reap = repoze.filesafe.reaper:main
+
+      [pytest11]
+      repoze.filesafe = repoze.filesafe.pytest_plugin
+
       [paste.filter_factory]
-      filesafe = repoze.filesafe:filesafe_filter_factory
+      filesafe = repoze.filesafe.middleware:filesafe_filter_factory
+      filesafe_upload = repoze.filesafe.middleware:upload_filter_factory
 
       [paste.filter_app_factory]
-      filesafe = repoze.filesafe:filesafe_filter_app_factory
+      filesafe = repoze.filesafe.middleware:filesafe_filter_app_factory
+      filesafe_upload = repoze.filesafe.middleware:upload_filter_app_factory
       """,
       )
@@ -1,33 +1,73 @@
-# repoze TransactionManager WSGI middleware
-import threading
-import warnings
-import transaction
-from repoze.filesafe.manager import FileSafeDataManager
-
-_local = threading.local()
+# Only the functions below are defined here. Everything else, including the
+# transaction machinery, is imported on first use to keep imports cheap.
+import contextvars
+import importlib
+
+_lazy_attributes = {
+    'CommitTimeBudgetExceeded': 'repoze.filesafe.manager',
+    'FileConflictError': 'repoze.filesafe.manager',
+    'FileIntegrityError': 'repoze.filesafe.manager',
+    'FileValidationError': 'repoze.filesafe.manager',
+    'FileSafeDataManager': 'repoze.filesafe.manager',
+    'FileSafeMiddleware': 'repoze.filesafe.middleware',
+    'FileSafeUploadMiddleware': 'repoze.filesafe.middleware',
+    'parse_multipart': 'repoze.filesafe.uploads',
+    'filesafe_filter_factory': 'repoze.filesafe.middleware',
+    'filesafe_filter_app_factory': 'repoze.filesafe.middleware',
+}
+
+_lazy_modules = ('manager', 'middleware', 'testing')
+
+# A manager pinned to the current context, such as the dummy manager from
+# repoze.filesafe.testing. If set it is used for every transaction.
+_pinned = contextvars.ContextVar('repoze.filesafe.manager', default=None)
 
 
 def _remove_manager(*a):
-    try:
-        del _local.manager
-    except AttributeError:
-        pass
+    _pinned.set(None)
 
-def _get_manager(tempdir=None):
-    manager = getattr(_local, 'manager', None)
+
+def get_manager(transaction_manager=None, tempdir=None):
+    """Return the data manager for the current transaction.
+
+    Each transaction gets its own data manager, which is stored on the
+    transaction itself. If no transaction manager is given the default
+    thread-local ``transaction.manager`` is used.
+    """
+    manager = _pinned.get()
     if manager is not None:
         return manager
-
-    manager = _local.manager = FileSafeDataManager(tempdir)
-    tx = transaction.get()
-    tx.join(manager)
-    tx.addAfterCommitHook(_remove_manager)
+    if transaction_manager is None:
+        import transaction
+        transaction_manager = transaction.manager
+    from repoze.filesafe.manager import FileSafeDataManager
+    tx = transaction_manager.get()
+    try:
+        manager = tx.data(FileSafeDataManager)
+    except KeyError:
+        manager = None
+    if manager is None:
+        manager = FileSafeDataManager(tempdir)
+        manager.transaction_manager = transaction_manager
+        tx.join(manager)
+        tx.set_data(FileSafeDataManager, manager)
     return manager
 
 
-def create_file(path, mode='w', tempdir=None):
+def _get_manager(tempdir=None):
+    return get_manager(tempdir=tempdir)
+
+
+def create_file(path, mode='w', tempdir=None, size_hint=None,
+                expected_size=None, expected_digest=None, compress=None):
     mgr = _get_manager(tempdir)
-    return mgr.create_file(path, mode)
+    return mgr.create_file(path, mode, size_hint, expected_size,
+                           expected_digest, compress)
+
+
+def create_files(paths, mode='w', tempdir=None):
+    mgr = _get_manager(tempdir)
+    return mgr.create_files(paths, mode)
 
 
 def rename_file(src, dst, recursive=False):
@@ -35,9 +75,39 @@ def rename_file(src, dst, recursive=False):
     return mgr.rename_file(src, dst, recursive)
 
 
-def open_file(path, mode='r'):
+def rename_files(pairs, recursive=False):
+    mgr = _get_manager()
+    return mgr.rename_files(pairs, recursive)
+
+
+def open_file(path, mode='r', compress=None):
+    mgr = _get_manager()
+    return mgr.open_file(path, mode, compress)
+
+
+def create_dir(path, tempdir=None):
+    mgr = _get_manager(tempdir)
+    return mgr.create_dir(path)
+
+
+def replace_dir(path, tempdir=None):
+    mgr = _get_manager(tempdir)
+    return mgr.replace_dir(path)
+
+
+def delete_tree(path):
+    mgr = _get_manager()
+    return mgr.delete_tree(path)
+
+
+def publish_dir(link_path, keep=1):
+    mgr = _get_manager()
+    return mgr.publish_dir(link_path, keep)
+
+
+def map_file(path):
     mgr = _get_manager()
-    return mgr.open_file(path, mode)
+    return mgr.map_file(path)
 
 
 def delete_file(path):
@@ -45,6 +115,11 @@ def delete_file(path):
     return mgr.delete_file(path)
 
 
+def delete_files(paths):
+    mgr = _get_manager()
+    return mgr.delete_files(paths)
+
+
 def file_exists(path):
     mgr = _get_manager()
     return mgr.file_exists(path)
@@ -55,26 +130,13 @@ def file_path(path):
     return mgr.file_path(path)
 
 
-class FileSafeMiddleware(object):
-    def __init__(self, app, config=None, **kwargs):
-        self.app = app
-        warnings.warn('FileSafeMiddleware is no longer required. You can '
-                      'safely remove it.',
-                      DeprecationWarning, stacklevel=2)
-
-    def __call__(self, environ, start_response):
-        if not hasattr(_local, "vault"):
-            _local.vault = FileSafeDataManager()
-        tx = transaction.get()
-        tx.join(_local.vault)
-        return self.app(environ, start_response)
-
-
-def filesafe_filter_factory(global_conf, **kwargs):
-    def filter(app):
-        return FileSafeMiddleware(app, global_conf, **kwargs)
-    return filter
-
-
-def filesafe_filter_app_factory(app, global_conf, **kwargs):
-    return FileSafeMiddleware(app, global_conf, **kwargs)
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('%s.%s' % (__name__, name))
+    try:
+        module = _lazy_attributes[name]
+    except KeyError:
+        raise AttributeError(
+                "module '%s' has no attribute '%s'" % (__name__, name))
+    value = globals()[name] = getattr(importlib.import_module(module), name)
+    return value
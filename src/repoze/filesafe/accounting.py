@@ -0,0 +1,227 @@
+"""Accounting of staged data, with limits to protect the temporary directory.
+
+Every data manager counts the files it staged and the data written to them
+in a `StagingUsage`, which also adds them to the process-wide
+`process_usage`. Both can have limits: writers are slowed down once a soft
+limit is exceeded, and an `OSError` with errno ``ENOSPC`` is raised if a
+hard limit would be exceeded. Staged files can also compute a `Checksum` of
+the data written to them.
+"""
+import errno
+import hashlib
+import threading
+import time
+import zlib
+
+
+class StagingUsage(object):
+    """Counters for the number of staged files and bytes.
+
+    Usage is also charged to the `parent`, if there is one. Writes sleep for
+    `throttle` seconds while the soft limit of this usage or its parent is
+    exceeded. Text is counted in bytes, after it has been encoded.
+    """
+
+    def __init__(self, parent=None, soft_limit=None, hard_limit=None,
+                 file_limit=None, throttle=0.01):
+        self.parent = parent
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.file_limit = file_limit
+        self.throttle = throttle
+        self.bytes = 0
+        self.files = 0
+        self.released = False
+        self.lock = threading.Lock()
+
+    def _exceeded(self, limit, what):
+        return OSError(errno.ENOSPC,
+                "Staging limit of %d %s exceeded" % (limit, what))
+
+    def _charge(self, size, files):
+        with self.lock:
+            if (files and self.file_limit is not None and
+                    self.files + files > self.file_limit):
+                raise self._exceeded(self.file_limit, "files")
+            if (size and self.hard_limit is not None and
+                    self.bytes + size > self.hard_limit):
+                raise self._exceeded(self.hard_limit, "bytes")
+            if self.parent is not None:
+                self.parent._charge(size, files)
+            self.bytes += size
+            self.files += files
+
+    def over_soft_limit(self):
+        if self.soft_limit is not None and self.bytes > self.soft_limit:
+            return True
+        return self.parent is not None and self.parent.over_soft_limit()
+
+    def add_file(self):
+        """Count a new staged file."""
+        if not self.released:
+            self._charge(0, 1)
+
+    def add_bytes(self, size):
+        """Count data written to a staged file.
+
+        Raises an OSError if this would exceed a hard limit, and sleeps if
+        a soft limit is already exceeded.
+        """
+        if self.released:
+            return
+        self._charge(size, 0)
+        if self.throttle and self.over_soft_limit():
+            time.sleep(self.throttle)
+
+    def _discharge(self, size, files):
+        with self.lock:
+            self.bytes -= size
+            self.files -= files
+        if self.parent is not None:
+            self.parent._discharge(size, files)
+
+    def release(self):
+        """Remove this usage from its parent.
+
+        Files which are written after this are no longer counted.
+        """
+        if self.released:
+            return
+        self.released = True
+        if self.parent is not None:
+            self.parent._discharge(self.bytes, self.files)
+
+    def metrics(self):
+        return dict(bytes=self.bytes, files=self.files)
+
+
+#: Usage of all data managers in this process.
+process_usage = StagingUsage()
+
+
+class _CRC32(object):
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+def new_hash(algorithm):
+    """Return a new hash object for `algorithm`.
+
+    All algorithms from :mod:`hashlib` are supported, as well as ``crc32``,
+    and the algorithms of the `xxhash` package if it is installed.
+    """
+    if algorithm == "crc32":
+        return _CRC32()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        pass
+    try:
+        import xxhash
+        return getattr(xxhash, algorithm)()
+    except (ImportError, AttributeError):
+        raise ValueError("Unsupported digest algorithm %s" % algorithm)
+
+
+class Checksum(object):
+    """The size and digest of the data written to a staged file.
+
+    Without an `algorithm` only the size is counted. Once the writer moves
+    away from the end of the data written so far, the data no longer
+    describes the file and `sequential` is false.
+    """
+
+    def __init__(self, algorithm=None):
+        self.hash = None if algorithm is None else new_hash(algorithm)
+        self.size = 0
+        self.sequential = True
+
+    def update(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return None if self.hash is None else self.hash.hexdigest()
+
+
+class AccountedFile(object):
+    """Wrap a staged file to count the data written to it.
+
+    If a `checksum` is given it is updated with all data written. Text is
+    encoded with the encoding of the file first. The file and the data
+    written to it are charged to `usage` until `discharge` is called.
+    """
+
+    def __init__(self, file, usage, checksum=None):
+        self._file = file
+        self._usage = usage
+        self.checksum = checksum
+        self.charged = 0
+        self.discharged = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            encoding = getattr(self._file, "encoding", None) or "utf-8"
+            errors = getattr(self._file, "errors", None) or "strict"
+            encoded = data.encode(encoding, errors)
+            size = len(encoded)
+        else:
+            encoded = None
+            size = memoryview(data).nbytes
+        if not self.discharged:
+            self._usage.add_bytes(size)
+            self.charged += size
+        if self.checksum is not None:
+            if encoded is None:
+                encoded = memoryview(data).cast("B")
+            self.checksum.update(encoded)
+        return self._file.write(data)
+
+    def discharge(self):
+        """Remove the file and its data from the usage again.
+
+        This is used when a staged file is deleted before the transaction
+        ends. Later writes are no longer counted.
+        """
+        if self.discharged:
+            return
+        self.discharged = True
+        if not self._usage.released:
+            self._usage._discharge(self.charged, 1)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def seek(self, *args):
+        position = self._file.seek(*args)
+        if self.checksum is not None and position != self.checksum.size:
+            self.checksum.sequential = False
+        return position
+
+    def truncate(self, *args):
+        size = self._file.truncate(*args)
+        if self.checksum is not None and size != self.checksum.size:
+            self.checksum.sequential = False
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def __iter__(self):
+        return iter(self._file)
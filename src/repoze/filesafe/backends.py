@@ -0,0 +1,969 @@
+"""Storage backends for the filesafe data manager.
+
+A backend performs all storage operations for a `FileSafeDataManager`: it
+stages new files and directories, and links, renames and removes files during
+the two-phase commit. The transaction logic itself lives in the data manager.
+"""
+import collections
+import errno
+import io
+import mmap
+import os
+import queue
+import shutil
+import stat
+import tempfile
+import threading
+
+# Bulk operations scan a directory instead of checking each path in it
+# separately once they touch at least this many paths in that directory, and
+# at least this fraction of the entries in it. The number of entries is
+# estimated from the size of the directory.
+SCAN_THRESHOLD = 8
+SCAN_FRACTION = 0.25
+_DIRENT_SIZE = 32
+
+# Flags for renameat2(2)
+RENAME_NOREPLACE = 1
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+_renameat2_function = None
+
+
+def _load_renameat2():
+    global _renameat2_function
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = libc.renameat2
+    except (ImportError, OSError, AttributeError):
+        function = False
+    else:
+        function.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+        function.restype = ctypes.c_int
+        function.get_errno = ctypes.get_errno
+    _renameat2_function = function
+    return function
+
+
+def renameat2(src, dst, flags, src_dir_fd=AT_FDCWD, dst_dir_fd=AT_FDCWD):
+    """Rename a file using the Linux renameat2 system call.
+
+    Raises an OSError with errno ENOSYS if renameat2 is not available.
+    """
+    function = _renameat2_function
+    if function is None:
+        function = _load_renameat2()
+    if not function:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS), src)
+    if function(src_dir_fd, os.fsencode(src),
+                dst_dir_fd, os.fsencode(dst), flags) != 0:
+        error = function.get_errno()
+        raise OSError(error, os.strerror(error), src, None, dst)
+
+
+# Flags for fallocate(2)
+FALLOC_FL_KEEP_SIZE = 1
+
+_fallocate_function = None
+
+
+def _load_fallocate():
+    global _fallocate_function
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (ImportError, OSError, AttributeError):
+        function = False
+    else:
+        function.argtypes = [ctypes.c_int, ctypes.c_int,
+                ctypes.c_int64, ctypes.c_int64]
+        function.restype = ctypes.c_int
+        function.get_errno = ctypes.get_errno
+    _fallocate_function = function
+    return function
+
+
+def preallocate(fd, size):
+    """Reserve disk space for `size` bytes of a new file.
+
+    On Linux the space is allocated with fallocate(2) without changing the
+    file size, so the file does not grow piece by piece while it is written.
+    Elsewhere, or if the filesystem does not support it, only the free space
+    is checked. An OSError with errno ENOSPC is raised if there is not enough
+    space. The kernel is also told that the file will be written
+    sequentially. Returns True if the space was allocated.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+    function = _fallocate_function
+    if function is None:
+        function = _load_fallocate()
+    if function:
+        if function(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+            return True
+        error = function.get_errno()
+        if error not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(error, os.strerror(error))
+    st = os.fstatvfs(fd)
+    if st.f_bavail * st.f_frsize < size:
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    return False
+
+
+def sync_file(path):
+    """Flush the data of a file, or the entries of a directory, to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # The size of a file may have changed, which fdatasync flushes too.
+        getattr(os, "fdatasync", os.fsync)(fd)
+    finally:
+        os.close(fd)
+
+
+def _enoent(path):
+    return OSError(errno.ENOENT,
+            "[Errno 2] No such file or directory: '%s'" % path)
+
+
+class DirectoryCache(object):
+    """A bounded cache of open directory file descriptors.
+
+    File operations are done relative to the directory of a path, which
+    saves the kernel from resolving the full path again for every operation
+    and protects against directories being swapped with symbolic links
+    halfway through a commit. The least recently used descriptors are closed
+    once more than `size` directories are open. Backends only use it while a
+    transaction commits, since a directory may be replaced before that.
+    """
+
+    enabled = set([os.rename, os.link, os.unlink, os.stat]) <= \
+            os.supports_dir_fd
+
+    def __init__(self, size=64):
+        self.size = max(size, 2)
+        self.fds = collections.OrderedDict()
+
+    def _open(self, directory):
+        fds = self.fds
+        try:
+            fds.move_to_end(directory)
+            return fds[directory]
+        except KeyError:
+            pass
+        fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        fds[directory] = fd
+        if len(fds) > self.size:
+            os.close(fds.popitem(last=False)[1])
+        return fd
+
+    def resolve(self, path):
+        """Return a ``(dir_fd, name)`` tuple for a path."""
+        (directory, name) = os.path.split(path)
+        if not (directory and name and self.enabled):
+            return (None, path)
+        return (self._open(directory), name)
+
+    def close(self):
+        while self.fds:
+            os.close(self.fds.popitem()[1])
+
+    def verify(self, directories):
+        """Open directories, and check that they are still at their path.
+
+        Returns the directories whose descriptor refers to another directory
+        than the one which lives at its path now.
+        """
+        moved = []
+        for directory in directories:
+            try:
+                st = os.fstat(self._open(directory))
+                current = os.stat(directory)
+            except OSError:
+                # Missing directories are reported by the operations on them
+                continue
+            if (st.st_dev, st.st_ino) != (current.st_dev, current.st_ino):
+                moved.append(directory)
+        return moved
+
+    def forget(self, *paths):
+        """Close the descriptors of directories which moved or vanished.
+
+        Descriptors for the paths and everything below them are closed, so
+        the next operation opens the directory which lives there now.
+        """
+        for path in paths:
+            prefix = os.path.join(path, "")
+            for directory in [directory for directory in self.fds
+                    if directory == path or directory.startswith(prefix)]:
+                os.close(self.fds.pop(directory))
+
+    def stat(self, path):
+        (fd, name) = self.resolve(path)
+        return os.stat(name, dir_fd=fd)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def rename(self, src, dst):
+        (src_fd, src_name) = self.resolve(src)
+        (dst_fd, dst_name) = self.resolve(dst)
+        os.rename(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+        self.forget(src, dst)
+
+    def renameat2(self, src, dst, flags):
+        (src_fd, src_name) = self.resolve(src)
+        (dst_fd, dst_name) = self.resolve(dst)
+        renameat2(src_name, dst_name, flags,
+                AT_FDCWD if src_fd is None else src_fd,
+                AT_FDCWD if dst_fd is None else dst_fd)
+        self.forget(src, dst)
+
+    def link(self, src, dst):
+        (src_fd, src_name) = self.resolve(src)
+        (dst_fd, dst_name) = self.resolve(dst)
+        os.link(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+
+    def unlink(self, path):
+        (fd, name) = self.resolve(path)
+        os.unlink(name, dir_fd=fd)
+
+    def sync(self, directory):
+        os.fsync(self._open(directory))
+
+
+_removals = queue.Queue()
+_remover = None
+
+
+def _remove_loop():
+    while True:
+        paths = _removals.get()
+        try:
+            for path in paths:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, True)
+                else:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        finally:
+            _removals.task_done()
+
+
+def _remove_later(paths):
+    """Remove files and directory trees in a background thread."""
+    global _remover
+    if not paths:
+        return
+    _removals.put(paths)
+    if _remover is None or not _remover.is_alive():
+        _remover = threading.Thread(
+                target=_remove_loop, name="repoze.filesafe remover")
+        _remover.daemon = True
+        _remover.start()
+
+
+class FilePool(object):
+    """Limit the number of staged files which are open at the same time.
+
+    Once more than `size` files are open the least recently used one is
+    closed. It is reopened transparently when it is used again. The pool
+    counts how many files it opened (`opens`) and closed to stay within its
+    budget (`evictions`), and the largest number of files open at the same
+    time (`peak`).
+    """
+
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.files = collections.OrderedDict()
+        self.opens = 0
+        self.evictions = 0
+        self.peak = 0
+
+    def acquire(self, staged):
+        """Return the open file object for a `StagedFile`."""
+        files = self.files
+        try:
+            files.move_to_end(staged)
+            return files[staged]
+        except KeyError:
+            pass
+        while len(files) >= self.size:
+            files.popitem(last=False)[0]._suspend()
+            self.evictions += 1
+        file = staged._open()
+        files[staged] = file
+        self.opens += 1
+        self.peak = max(self.peak, len(files))
+        return file
+
+    def discard(self, staged):
+        self.files.pop(staged, None)
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[0]._suspend()
+
+    def metrics(self):
+        """Return a dictionary with the current fd usage of this pool."""
+        return dict(open=len(self.files), peak=self.peak, opens=self.opens,
+                    evictions=self.evictions, budget=self.size)
+
+
+class StagedFile(object):
+    """A staged file which only holds a file descriptor while it is used.
+
+    The file is opened on first use and may be closed again by its
+    `FilePool`. When it is used after that it is reopened at the same
+    position. The file already exists, so it is never truncated, which
+    would drop its preallocated space.
+    """
+
+    def __init__(self, name, mode, pool):
+        self.name = name
+        self.mode = mode
+        self.pool = pool
+        self.closed = False
+        self._file = None
+        self._position = None
+
+    def _open(self):
+        mode = self.mode
+        if 'a' not in mode:
+            mode = mode.replace('w', 'r').replace('x', 'r')
+            if '+' not in mode:
+                mode += '+'
+        self._file = open(self.name, mode)
+        if self._position is not None:
+            self._file.seek(self._position)
+        return self._file
+
+    def _suspend(self):
+        file = self._file
+        if file is not None:
+            self._position = file.tell()
+            self._file = None
+            file.close()
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        return getattr(self.pool.acquire(self), name)
+
+    def close(self):
+        if not self.closed:
+            self.pool.discard(self)
+            self._suspend()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.pool.acquire(self))
+
+
+class LocalBackend(object):
+    """Store files on the local filesystem.
+
+    Staged files are created in a staging directory inside `tempdir`, which
+    must be on the same filesystem as the target paths.
+    """
+
+    def __init__(self, tempdir=None, dir_cache_size=64, fd_budget=None):
+        self.tempdir = tempdir
+        self.stagedir = None
+        self.dirs = DirectoryCache(dir_cache_size)
+        self.files = None if fd_budget is None else FilePool(fd_budget)
+        # Directory descriptors are only used while a transaction commits.
+        # Before that other transactions may still replace directories.
+        self.committing = False
+
+    def _real(self, path):
+        return path
+
+    def _virtual(self, path):
+        return path
+
+    def _staging_dir(self):
+        """Return the directory with all temporary files of this backend.
+
+        Its name contains the process id, thread id and an id for the
+        transaction, so leftovers can be traced back to their owner.
+        """
+        if self.stagedir is None:
+            self.stagedir = tempfile.mkdtemp(dir=self._real(self.tempdir),
+                    prefix="filesafe-%d-%d-%x-" % (
+                        os.getpid(), threading.get_ident(), id(self)))
+        return self.stagedir
+
+    def stage_file(self, mode, size_hint=None):
+        """Create a new staged file.
+
+        If `size_hint` is given, disk space for that many bytes is reserved.
+        Returns a ``(file, path)`` tuple with an open file object and the
+        path of the staged file.
+        """
+        if self.files is None:
+            file = tempfile.NamedTemporaryFile(
+                mode=mode, dir=self._staging_dir(), delete=False)
+            (fd, name) = (file.fileno(), file.name)
+        else:
+            (fd, name) = tempfile.mkstemp(dir=self._staging_dir())
+            file = StagedFile(name, mode, self.files)
+        try:
+            if size_hint:
+                preallocate(fd, size_hint)
+        except OSError:
+            file.close()
+            os.unlink(name)
+            raise
+        finally:
+            if self.files is not None:
+                os.close(fd)
+        return (file, self._virtual(name))
+
+    def stage_dir(self):
+        return self.make_dir(self._virtual(self._staging_dir()), "tmp")
+
+    def make_dir(self, directory, prefix):
+        """Create a new uniquely named directory in `directory`.
+
+        Unlike the staging directory itself it gets the normal permissions
+        for the umask of the process, since it is committed as it is.
+        """
+        directory = self._real(directory or os.curdir)
+        for attempt in range(100):
+            path = os.path.join(directory, prefix + os.urandom(4).hex())
+            try:
+                os.mkdir(path, 0o777)
+            except FileExistsError:
+                continue
+            return self._virtual(path)
+        raise FileExistsError(errno.EEXIST,
+                "No usable directory name found in %s" % directory)
+
+    def is_staged(self, path):
+        return (self.stagedir is not None and
+                os.path.dirname(self._real(path)) == self.stagedir)
+
+    def local_path(self, path):
+        """Return the path of a file on the local filesystem."""
+        return self._real(path)
+
+    def stat(self, path):
+        if self.committing:
+            return self.dirs.stat(self._real(path))
+        return os.stat(self._real(path))
+
+    def exists(self, path):
+        if self.committing:
+            return self.dirs.exists(self._real(path))
+        return os.path.exists(self._real(path))
+
+    def open_dirs(self, directories):
+        """Open the directories a commit will change.
+
+        From now on files are looked up relative to these directories.
+        Returns the directories which were replaced after they were opened.
+        """
+        self.committing = True
+        return [self._virtual(directory) for directory in self.dirs.verify(
+                [self._real(path) for path in directories if path])]
+
+    def isdir(self, path):
+        return os.path.isdir(self._real(path))
+
+    def islink(self, path):
+        return os.path.islink(self._real(path))
+
+    def lexists(self, path):
+        return os.path.lexists(self._real(path))
+
+    def lookup(self, paths):
+        """Stat many paths, grouped per directory.
+
+        Directories with several paths are scanned once, so paths which do not
+        exist are resolved without a system call of their own. Returns a
+        dictionary mapping each path to its stat result, or None if the path
+        does not exist.
+        """
+        per_directory = {}
+        for path in paths:
+            per_directory.setdefault(os.path.dirname(path), []).append(path)
+        found = {}
+        for directory, names in per_directory.items():
+            if not self._worth_scanning(directory, len(names)):
+                for path in names:
+                    try:
+                        found[path] = os.stat(self._real(path))
+                    except OSError:
+                        found[path] = None
+                continue
+            try:
+                entries = dict((entry.name, entry) for entry in
+                        os.scandir(self._real(directory or os.curdir)))
+            except OSError:
+                entries = {}
+            for path in names:
+                entry = entries.get(os.path.basename(path))
+                try:
+                    found[path] = None if entry is None else entry.stat()
+                except OSError:
+                    found[path] = None
+        return found
+
+    def _worth_scanning(self, directory, count):
+        if count < SCAN_THRESHOLD:
+            return False
+        try:
+            size = os.stat(self._real(directory or os.curdir)).st_size
+        except OSError:
+            return False
+        return count >= SCAN_FRACTION * (size // _DIRENT_SIZE)
+
+    def open(self, path, mode):
+        return open(self._real(path), mode)
+
+    def fstat(self, file, path):
+        """Return the stat result for a file opened with `open`."""
+        return os.fstat(file.fileno())
+
+    def map(self, path):
+        """Return a ``(mapping, stat)`` tuple for a read-only memory map.
+
+        Empty files can not be mapped, so an empty memoryview is returned for
+        them.
+        """
+        with open(self._real(path), "rb") as file:
+            st = os.fstat(file.fileno())
+            if not st.st_size:
+                return (memoryview(b""), st)
+            return (mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), st)
+
+    def listdir(self, path):
+        return os.listdir(self._real(path or os.curdir))
+
+    def readlink(self, path):
+        return os.readlink(self._real(path))
+
+    def symlink(self, target, path):
+        os.symlink(target, self._real(path))
+
+    def rename(self, src, dst, recursive=False):
+        if recursive:
+            os.renames(self._real(src), self._real(dst))
+            # os.renames also creates and removes parent directories.
+            self.dirs.close()
+        else:
+            self.dirs.rename(self._real(src), self._real(dst))
+
+    def exchange(self, src, dst):
+        """Atomically swap two paths."""
+        self.dirs.renameat2(self._real(src), self._real(dst), RENAME_EXCHANGE)
+
+    def rename_noreplace(self, src, dst):
+        """Rename a file, failing with EEXIST if the destination exists."""
+        self.dirs.renameat2(
+                self._real(src), self._real(dst), RENAME_NOREPLACE)
+
+    def link(self, src, dst):
+        self.dirs.link(self._real(src), self._real(dst))
+
+    def unlink(self, path):
+        self.dirs.unlink(self._real(path))
+
+    def remove_tree(self, path):
+        shutil.rmtree(self._real(path))
+        self.dirs.forget(self._real(path))
+
+    def trim_files(self, paths):
+        """Release the disk space reserved past the end of staged files."""
+        for path in paths:
+            path = self._real(path)
+            os.truncate(path, os.stat(path).st_size)
+
+    def sync_files(self, paths):
+        """Flush the data of files to disk.
+
+        Directories are flushed with everything in them.
+        """
+        for path in paths:
+            path = self._real(path)
+            if not os.path.isdir(path):
+                sync_file(path)
+                continue
+            for (directory, dirs, files) in os.walk(path):
+                for name in files:
+                    name = os.path.join(directory, name)
+                    if not os.path.islink(name):
+                        sync_file(name)
+                sync_file(directory)
+
+    def sync_dirs(self, paths):
+        """Flush the entries of directories to disk.
+
+        Syncs are shared with other transactions in this process which
+        sync the same directories at the same time.
+        """
+        from repoze.filesafe.groupcommit import directory_syncs
+        directory_syncs.sync(
+                [self._real(path or os.curdir) for path in paths],
+                self.dirs.sync)
+
+    def discard(self, paths):
+        """Remove files and directory trees in the background."""
+        _remove_later([self._real(path) for path in paths])
+
+    def release(self, aborted=False):
+        """Release all resources at the end of a transaction.
+
+        Returns a list of paths which still need to be discarded.
+        """
+        leftovers = []
+        if self.stagedir is not None:
+            if aborted:
+                leftovers.append(self._virtual(self.stagedir))
+            else:
+                try:
+                    os.rmdir(self.stagedir)
+                except OSError:
+                    leftovers.append(self._virtual(self.stagedir))
+        self.stagedir = None
+        self.committing = False
+        self.dirs.close()
+        if self.files is not None:
+            self.files.close()
+        return leftovers
+
+
+class ChrootBackend(LocalBackend):
+    """Store files below a root directory.
+
+    All paths, including `tempdir`, are interpreted relative to `root`, and
+    ``..`` can not be used to escape from it. Symbolic links inside the root
+    are followed as usual.
+    """
+
+    def __init__(self, root, tempdir="/", dir_cache_size=64, fd_budget=None):
+        LocalBackend.__init__(self, tempdir, dir_cache_size, fd_budget)
+        self.root = os.path.abspath(root)
+
+    def _real(self, path):
+        path = os.path.normpath(os.path.join(os.sep, path))
+        return os.path.join(self.root, path.lstrip(os.sep))
+
+    def _virtual(self, path):
+        path = os.path.relpath(path, self.root)
+        return os.sep if path == os.curdir else os.path.join(os.sep, path)
+
+
+# MockFileMixIn must not be derived from object, or the closed attributed
+# from StringIO will disappear in Python 2. This unfortuantely means we can
+# also not use super(), so we need the _base attribute with the base class.
+class MockFileMixin:
+    def close(self):
+        self.mockdata = self.getvalue()
+        self._base.close(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+
+class MockBytesIO(MockFileMixin, io.BytesIO):
+    _base = io.BytesIO
+
+
+class MockStringIO(MockFileMixin, io.StringIO):
+    _base = io.StringIO
+
+
+class MemoryReader(io.BufferedIOBase):
+    """A read-only binary file backed by a memoryview.
+
+    Reading never copies more than the requested data, and `getbuffer`
+    returns the remaining data without copying it at all.
+    """
+
+    def __init__(self, data):
+        io.BufferedIOBase.__init__(self)
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _slice(self, size):
+        self._checkClosed()
+        start = min(self._pos, len(self._view))
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def read(self, size=-1):
+        return self._slice(size).tobytes()
+
+    read1 = read
+
+    def readinto(self, buffer):
+        view = self._slice(memoryview(buffer).nbytes)
+        memoryview(buffer).cast("B")[:len(view)] = view
+        return len(view)
+
+    readinto1 = readinto
+
+    def getbuffer(self):
+        """Return a memoryview of the data which has not been read yet."""
+        return self._slice(-1)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        io.BufferedIOBase.close(self)
+
+
+class _MemoryStat(object):
+
+    def __init__(self, file, size):
+        self.st_ino = id(file)
+        self.st_mode = stat.S_IFREG | 0o644
+        self.st_mtime_ns = 0
+        self.st_size = size
+
+
+class MemoryBackend(object):
+    """Keep all files in memory.
+
+    Files are stored in the `data` dictionary, which maps paths to in-memory
+    file objects. Files which are not in `data` can still be opened for
+    reading from disk. Directories only exist as prefixes of file paths, or
+    when they were staged. Symbolic links are not supported.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.directories = set()
+        self.staged = set()
+        self.counter = 0
+
+    def _file_class(self, mode):
+        return MockBytesIO if 'b' in mode else MockStringIO
+
+    def _children(self, path):
+        prefix = path.rstrip("/") + "/"
+        return [name for name in self.data if name.startswith(prefix)]
+
+    def _value(self, file):
+        return file.mockdata if file.closed else file.getvalue()
+
+    def _size(self, file):
+        if isinstance(file, io.BytesIO) and not file.closed:
+            # getvalue() would make the next write copy the whole buffer
+            with file.getbuffer() as view:
+                return view.nbytes
+        data = self._value(file)
+        if isinstance(data, str):
+            # Sizes are in bytes, as if the text was written to disk.
+            return len(data.encode("utf-8"))
+        return len(data)
+
+    def stage_file(self, mode, size_hint=None):
+        self.counter += 1
+        path = "tmp%d" % self.counter
+        self.data[path] = file = self._file_class(mode)()
+        self.staged.add(path)
+        return (file, path)
+
+    def stage_dir(self):
+        self.counter += 1
+        path = "tmpdir%d" % self.counter
+        self.directories.add(path)
+        self.staged.add(path)
+        return path
+
+    def make_dir(self, directory, prefix):
+        self.counter += 1
+        path = os.path.join(directory, "%s%d" % (prefix, self.counter))
+        self.directories.add(path)
+        return path
+
+    def is_staged(self, path):
+        return path in self.staged
+
+    def local_path(self, path):
+        return None
+
+    def stat(self, path):
+        try:
+            file = self.data[path]
+        except KeyError:
+            raise _enoent(path)
+        return _MemoryStat(file, self._size(file))
+
+    def exists(self, path):
+        return path in self.data
+
+    def isdir(self, path):
+        return path in self.directories or bool(self._children(path))
+
+    def islink(self, path):
+        return False
+
+    def lexists(self, path):
+        return self.exists(path) or self.isdir(path)
+
+    def lookup(self, paths):
+        found = {}
+        for path in paths:
+            try:
+                found[path] = self.stat(path)
+            except OSError:
+                found[path] = None
+        return found
+
+    def open(self, path, mode):
+        if path not in self.data:
+            return open(path, mode)
+        file = self.data[path]
+        if not file.closed:
+            return file
+        data = file.mockdata
+        if 'b' in mode and isinstance(data, str):
+            data = data.encode("utf-8")
+        if mode in ("rb", "br"):
+            # Share the stored data instead of copying it
+            return MemoryReader(data)
+        return self._file_class(mode)(data)
+
+    def fstat(self, file, path):
+        try:
+            return self.stat(path)
+        except OSError:
+            return None
+
+    def map(self, path):
+        if path not in self.data:
+            with open(path, "rb") as file:
+                return (memoryview(file.read()), None)
+        data = self._value(self.data[path])
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        return (memoryview(data), self.stat(path))
+
+    def listdir(self, path):
+        names = set(name[len(path):].lstrip("/").split("/")[0]
+                for name in self._children(path))
+        names.update(os.path.basename(name) for name in self.directories
+                if os.path.dirname(name) == path)
+        return sorted(names)
+
+    def readlink(self, path):
+        raise OSError(errno.EINVAL, "Symbolic links are not supported", path)
+
+    def symlink(self, target, path):
+        raise OSError(errno.ENOSYS, "Symbolic links are not supported", path)
+
+    def rename(self, src, dst, recursive=False):
+        if src in self.data:
+            self.data[dst] = self.data.pop(src)
+        elif self.isdir(src):
+            for name in self._children(src):
+                self.data[dst + name[len(src):]] = self.data.pop(name)
+            if src in self.directories:
+                self.directories.remove(src)
+                self.directories.add(dst)
+        else:
+            raise _enoent(src)
+
+    def exchange(self, src, dst):
+        if src not in self.data or dst not in self.data:
+            if self.isdir(src) or self.isdir(dst):
+                raise OSError(errno.EINVAL, "Can not exchange directories")
+            raise _enoent(src if src not in self.data else dst)
+        (self.data[src], self.data[dst]) = (self.data[dst], self.data[src])
+
+    def rename_noreplace(self, src, dst):
+        if self.lexists(dst):
+            raise OSError(errno.EEXIST, "[Errno 17] File exists: '%s'" % dst)
+        self.rename(src, dst)
+
+    def link(self, src, dst):
+        if src not in self.data:
+            raise _enoent(src)
+        self.data[dst] = self.data[src]
+
+    def unlink(self, path):
+        if path not in self.data:
+            raise _enoent(path)
+        del self.data[path]
+
+    def remove_tree(self, path):
+        if not self.isdir(path):
+            raise _enoent(path)
+        for name in self._children(path):
+            del self.data[name]
+        self.directories.discard(path)
+
+    def open_dirs(self, directories):
+        return []
+
+    def trim_files(self, paths):
+        pass
+
+    def sync_files(self, paths):
+        pass
+
+    def sync_dirs(self, paths):
+        pass
+
+    def discard(self, paths):
+        for path in paths:
+            try:
+                self.remove_tree(path)
+            except OSError:
+                pass
+
+    def release(self, aborted=False):
+        for path in self.staged:
+            self.data.pop(path, None)
+            self.discard([path])
+        self.staged.clear()
+        return []
@@ -0,0 +1,172 @@
+"""Compression of staged files.
+
+Data written to a `CompressingWriter` is split into chunks, which are
+compressed in parallel in a thread pool. Every chunk becomes a separate gzip
+member or zstd frame, so the result is a normal compressed file which can be
+read with any gzip or zstd tool.
+"""
+import collections
+import concurrent.futures
+import functools
+import gzip
+import io
+import os
+import threading
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _default_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix="repoze.filesafe compression")
+        return _pool
+
+
+def _zstd():
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ValueError("zstd compression requires the zstandard package")
+
+
+def _zstd_compress(level, data):
+    zstd = _zstd()
+    if zstd.__name__ == "zstandard":
+        return zstd.ZstdCompressor(level=level).compress(data)
+    return zstd.compress(data, level)
+
+
+def compressor(format, level=None):
+    """Return a function which compresses a chunk of data.
+
+    A ValueError is raised if `format` is not supported.
+    """
+    if format == "gzip":
+        return functools.partial(
+                gzip.compress, compresslevel=6 if level is None else level)
+    if format == "zstd":
+        _zstd()
+        return functools.partial(_zstd_compress, 3 if level is None else level)
+    raise ValueError("Unsupported compression format %s" % format)
+
+
+class CompressingWriter(io.BufferedIOBase):
+    """Compress data in chunks of `chunk_size` bytes before writing it.
+
+    Chunks are compressed by `executor`, by default a thread pool shared by
+    all writers, and written to `file` in order. At most `max_pending`
+    chunks are compressed at the same time. Closing the writer closes
+    `file` as well.
+    """
+
+    def __init__(self, file, format="gzip", level=None, executor=None,
+                 chunk_size=1 << 20, max_pending=None):
+        self._file = file
+        self._compress = compressor(format, level)
+        self._executor = executor or _default_pool()
+        self._chunk_size = chunk_size
+        self._max_pending = max_pending or 2 * (os.cpu_count() or 1)
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        with memoryview(data) as view:
+            self._buffer += view.cast("B")
+            size = view.nbytes
+        if len(self._buffer) >= self._chunk_size:
+            self._submit()
+        return size
+
+    def _submit(self):
+        (chunk, self._buffer) = (self._buffer, bytearray())
+        self._pending.append(self._executor.submit(self._compress, chunk))
+        self._drain(self._max_pending)
+
+    def _drain(self, limit):
+        pending = self._pending
+        while pending and (len(pending) > limit or pending[0].done()):
+            self._file.write(pending.popleft().result())
+
+    def flush(self):
+        if self.closed:
+            return
+        if self._buffer:
+            self._submit()
+        self._drain(0)
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            while self._pending:
+                self._pending.popleft().cancel()
+            self._file.close()
+
+
+class DecompressingReader(io.BufferedIOBase):
+    """Read the decompressed data of a compressed file.
+
+    Closing the reader closes `file` as well.
+    """
+
+    def __init__(self, file, format="gzip"):
+        self._file = file
+        if format == "gzip":
+            self._stream = gzip.GzipFile(fileobj=file, mode="rb")
+        elif format == "zstd":
+            zstd = _zstd()
+            if zstd.__name__ == "zstandard":
+                self._stream = zstd.ZstdDecompressor().stream_reader(
+                        file, read_across_frames=True, closefd=False)
+            else:
+                self._stream = zstd.ZstdFile(file)
+        else:
+            raise ValueError("Unsupported compression format %s" % format)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        return self._stream.read(size)
+
+    def read1(self, size=-1):
+        return self.read(size if size and size > 0 else io.DEFAULT_BUFFER_SIZE)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._stream.close()
+        finally:
+            self._file.close()
+            super().close()
+
+
+def open_compressed(file, format, mode):
+    """Wrap `file` to read the decompressed data, in text or binary mode."""
+    if "w" in mode or "a" in mode or "x" in mode or "+" in mode:
+        raise ValueError("Compressed files can only be opened for reading")
+    reader = DecompressingReader(file, format)
+    if "b" in mode:
+        return reader
+    return io.TextIOWrapper(reader)
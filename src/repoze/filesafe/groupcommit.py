@@ -0,0 +1,109 @@
+"""Share directory syncs between transactions which commit at the same time.
+
+Flushing a directory to disk is slow, and when many threads commit to the
+same directories at once each of them would flush them separately. Like the
+group commit of a database, the `GroupCommit` coordinator lets transactions
+which sync a directory within a short window share a single flush: the
+first transaction waits for the window to pass, flushes the directory once
+for everybody who joined in the meantime, and wakes them up.
+"""
+import threading
+import time
+
+
+class _Round(object):
+    """A single flush of a directory, shared by all transactions in it."""
+
+    def __init__(self):
+        self.leader = False
+        self.done = False
+        self.error = None
+
+
+class _Directory(object):
+
+    def __init__(self):
+        self.pending = None
+        self.running = False
+
+
+class GroupCommit(object):
+    """Coordinate directory syncs of all transactions in a process.
+
+    Transactions which ask for a sync within `window` seconds of each other
+    share one flush per directory.
+    """
+
+    def __init__(self, window=0.002):
+        self.window = window
+        self.lock = threading.Condition()
+        self.directories = {}
+        self.requests = 0
+        self.syncs = 0
+
+    def _join(self, path):
+        directory = self.directories.get(path)
+        if directory is None:
+            directory = self.directories[path] = _Directory()
+        if directory.pending is None:
+            directory.pending = _Round()
+        return (directory, directory.pending)
+
+    def _run(self, path, directory, group, sync):
+        with self.lock:
+            while directory.running:
+                self.lock.wait()
+            # Everybody who joined so far is covered by this flush, later
+            # requests start a new group.
+            directory.pending = None
+            directory.running = True
+        try:
+            sync(path)
+        except Exception as e:
+            group.error = e
+        finally:
+            # Transactions waiting for this flush must always be woken up.
+            with self.lock:
+                group.done = True
+                directory.running = False
+                self.syncs += 1
+                if directory.pending is None:
+                    del self.directories[path]
+                self.lock.notify_all()
+
+    def sync(self, paths, sync):
+        """Flush the directories in `paths` to disk.
+
+        `sync` is called with a path to flush a single directory. It is only
+        called for directories which no other transaction is about to flush.
+        Returns once all directories have been flushed after this call was
+        made. If flushing a directory failed its error is raised, in every
+        transaction which waited for that flush.
+        """
+        groups = []
+        leading = []
+        with self.lock:
+            for path in paths:
+                (directory, group) = self._join(path)
+                if not group.leader:
+                    group.leader = True
+                    leading.append((path, directory, group))
+                groups.append(group)
+            self.requests += len(groups)
+        if leading and self.window:
+            time.sleep(self.window)
+        for (path, directory, group) in leading:
+            self._run(path, directory, group, sync)
+        with self.lock:
+            while not all(group.done for group in groups):
+                self.lock.wait()
+        for group in groups:
+            if group.error is not None:
+                raise group.error
+
+    def metrics(self):
+        return dict(requests=self.requests, syncs=self.syncs)
+
+
+#: The coordinator used by all data managers in this process.
+directory_syncs = GroupCommit()
@@ -1,91 +1,819 @@
+import concurrent.futures
 import errno
+import fcntl
+import io
 import logging
+import mmap
 import os.path
+import shutil
+import stat
 import tempfile
+import threading
+import time
+import weakref
 from zope.interface import implementer
 from transaction.interfaces import IDataManager
+from transaction.interfaces import TransientError
+from repoze.filesafe.accounting import AccountedFile
+from repoze.filesafe.accounting import Checksum
+from repoze.filesafe.accounting import StagingUsage
+from repoze.filesafe.accounting import new_hash
+from repoze.filesafe.accounting import process_usage
+from repoze.filesafe.backends import LocalBackend
+from repoze.filesafe.planner import plan_commit
+from repoze.filesafe.tracing import CountingBackend
+from repoze.filesafe.tracing import get_tracer
+from repoze.filesafe.tracing import traced
 
 log = logging.getLogger("repoze.filesafe")
 
 
+class FileConflictError(TransientError):
+    """A file used by a transaction was modified by someone else.
+
+    This is a transient error, so transaction retry loops such as
+    ``transaction.manager.attempts()`` will retry the transaction.
+    """
+
+    def __init__(self, path):
+        TransientError.__init__(self,
+                "%s was modified by a concurrent transaction" % path)
+        self.path = path
+
+
+class FileValidationError(Exception):
+    """A validator rejected a staged file."""
+
+    def __init__(self, path, validator, error):
+        Exception.__init__(self, "%s was rejected by %s: %s" % (
+            path, validator, error))
+        self.path = path
+        self.validator = validator
+        self.error = error
+
+
+class FileIntegrityError(Exception):
+    """A staged file does not contain the data which was written to it."""
+
+    def __init__(self, path, reason):
+        Exception.__init__(self, "%s: %s" % (path, reason))
+        self.path = path
+
+
+class CommitTimeBudgetExceeded(Exception):
+    """The estimated time to commit exceeds the commit time budget."""
+
+    def __init__(self, estimate, budget):
+        Exception.__init__(self,
+                "Commit would take about %.3f seconds, but the budget is "
+                "%.3f seconds" % (estimate, budget))
+        self.estimate = estimate
+        self.budget = budget
+
+
+def _generation_prefix(name):
+    return "%s.generation-" % name
+
+
+def _generation_history(link_path):
+    return "%s.generations" % link_path
+
+
+_validator_pool = None
+_validator_pool_lock = threading.Lock()
+
+
+def _default_validator_pool():
+    global _validator_pool
+    with _validator_pool_lock:
+        if _validator_pool is None:
+            _validator_pool = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix="repoze.filesafe validator")
+        return _validator_pool
+
+
+def _run_validator(validator, path, filename):
+    start = time.perf_counter()
+    validator(path, filename)
+    return time.perf_counter() - start
+
+
+def _decompressed_copy(filename, format):
+    """Decompress a staged file into a new file next to it."""
+    from repoze.filesafe.compression import open_compressed
+    (fd, copy) = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with open(fd, "wb") as output:
+        with open_compressed(open(filename, "rb"), format, "rb") as reader:
+            shutil.copyfileobj(reader, output, 1 << 16)
+    return copy
+
+
+# Average time to commit a single file, in seconds. This is updated after
+# every commit in this process, and used to estimate how long a commit takes.
+_operation_time = 0.001
+_operation_time_lock = threading.Lock()
+
+
+def _record_commit_time(operations, elapsed):
+    global _operation_time
+    if not operations:
+        return
+    with _operation_time_lock:
+        _operation_time = 0.8 * _operation_time + 0.2 * elapsed / operations
+
+
+def _stat_key(st):
+    # A list, so it compares equal after a round trip through a SpillVault.
+    if stat.S_ISDIR(st.st_mode):
+        # Files are added to directories all the time, by this transaction
+        # as well as by others. Only replacing the directory is a conflict.
+        return [st.st_ino, stat.S_IFDIR]
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
 @implementer(IDataManager)
 class FileSafeDataManager:
 
     transaction_manager = None
 
-    def __init__(self, tempdir=None):
+    #: Use the Linux renameat2 system call to swap staged files with their
+    #: targets during commit, if the system supports it.
+    use_renameat2 = False
+
+    #: Maximum number of directories kept open during commit.
+    dir_cache_size = 64
+
+    #: If set, `create_file` returns `StagedFile` proxies, of which at most
+    #: this many are kept open at the same time.
+    fd_budget = None
+
+    #: If set, keep the vault, and the state of the files seen by the
+    #: transaction, in `SpillVault` databases in the temporary directory,
+    #: with at most this many entries of each in memory.
+    vault_cache_size = None
+
+    #: Maximum number of bytes a transaction may reserve with size hints.
+    space_budget = None
+
+    #: Limits for the data staged by a transaction. Writers are slowed down
+    #: once the soft limit is exceeded, and an OSError is raised if the hard
+    #: limits would be exceeded.
+    staged_bytes_soft_limit = None
+    staged_bytes_hard_limit = None
+    staged_files_limit = None
+
+    #: Compute a digest of all data written to staged files with this
+    #: algorithm, for example ``"blake2b"`` or ``"crc32"``.
+    digest_algorithm = None
+
+    #: Validators which are called for every new file before commit.
+    validators = ()
+
+    #: The `concurrent.futures.Executor` used to run validators. By default
+    #: a thread pool shared by all data managers is used.
+    validator_executor = None
+
+    #: The compression level used for files created with `compress`, or
+    #: None for the default level of the format.
+    compression_level = None
+
+    #: The `concurrent.futures.Executor` used to compress files. By default
+    #: a thread pool shared by all data managers is used.
+    compression_executor = None
+
+    #: Functions which are called with the number of committed files, the
+    #: total number of files, and the number of bytes moved into place
+    #: while the transaction commits.
+    progress_callbacks = ()
+
+    #: If set, the maximum number of seconds a commit may take. Commits
+    #: which are estimated to take longer fail before any file is changed.
+    commit_time_budget = None
+
+    #: Flush new files to disk before they are moved into place, and every
+    #: directory changed by the commit after that, so the new files survive
+    #: a crash once the transaction has committed. Transactions in this
+    #: process which commit at the same time share the directory syncs.
+    sync_directories = False
+
+    def __init__(self, tempdir=None, backend=None):
         self.tempdir = tempdir
+        if backend is None:
+            backend = LocalBackend(
+                    tempdir, self.dir_cache_size, self.fd_budget)
+        if get_tracer() is not None:
+            backend = CountingBackend(backend)
+        self.backend = backend
         self.in_commit = False
-        self.vault = {}
+        if self.vault_cache_size is None:
+            self.vault = {}
+            self.observed = {}
+        else:
+            from repoze.filesafe.vault import SpillVault
+            self.vault = SpillVault(tempdir, self.vault_cache_size)
+            self.observed = SpillVault(tempdir, self.vault_cache_size)
+        self.reserved = 0
+        self.usage = self._new_usage()
+        self.checksums = {}
+        # The accounted files of the staged files, to discharge their usage
+        # if they are deleted again.
+        self.accounted = {}
+        self.digests = {}
+        self.validators = list(self.validators)
+        self.progress_callbacks = list(self.progress_callbacks)
+        self.validation_timings = {}
+        self.mappings = weakref.WeakSet()
+        self.commit_plan = None
 
-    def _cleanup(self):
-        from repoze.filesafe import _remove_manager
+    def _release_mappings(self):
+        for mapping in list(self.mappings):
+            try:
+                mapping.close()
+            except BufferError:
+                # Someone still holds a memoryview. The mapping stays valid
+                # after the file is renamed, so leave it alone.
+                pass
+        self.mappings.clear()
+
+    def _new_usage(self):
+        return StagingUsage(process_usage, self.staged_bytes_soft_limit,
+                self.staged_bytes_hard_limit, self.staged_files_limit)
+
+    def _cleanup(self, transaction=None):
+        self._release_mappings()
         self.vault.clear()
-        _remove_manager()
+        self.observed.clear()
+        self.reserved = 0
+        self.usage.release()
+        self.usage = self._new_usage()
+        self.checksums.clear()
+        self.accounted.clear()
+        self.commit_plan = None
+        if transaction is not None:
+            transaction.set_data(FileSafeDataManager, None)
+
+    def _remember(self, path, st):
+        """Remember the state of a file as seen by this transaction."""
+        if path not in self.observed:
+            self.observed[path] = None if st is None else _stat_key(st)
+
+    def _observe(self, path):
+        if path in self.observed:
+            return
+        try:
+            st = self.backend.stat(path)
+        except OSError:
+            st = None
+        self._remember(path, st)
+
+    def _check_conflicts(self):
+        for path, seen in self.observed.items():
+            try:
+                current = _stat_key(self.backend.stat(path))
+            except OSError:
+                current = None
+            if current != seen:
+                raise FileConflictError(path)
+
+    def _verify_checksums(self):
+        digests = {}
+        for path, (staged, checksum, size, digest) in self.checksums.items():
+            info = self.vault.get(path)
+            if info is None or info.get("tempfile") != staged:
+                continue
+            actual = self.backend.stat(staged).st_size
+            # Writers which seek, such as zipfile, overwrite their own data,
+            # so only the file itself tells what they wrote.
+            if checksum.sequential and actual != checksum.size:
+                raise FileIntegrityError(path,
+                        "%d bytes were written, but the file has %d bytes" %
+                        (checksum.size, actual))
+            if size is not None and size != actual:
+                raise FileIntegrityError(path,
+                        "expected %d bytes, but %d bytes were written" %
+                        (size, actual))
+            hexdigest = checksum.hexdigest()
+            if hexdigest is not None and not checksum.sequential:
+                hexdigest = self._file_digest(staged)
+            if digest is not None and digest != hexdigest:
+                raise FileIntegrityError(path,
+                        "expected digest %s, but got %s" % (digest, hexdigest))
+            if hexdigest is not None:
+                digests[path] = hexdigest
+        self.digests = digests
+
+    def _file_digest(self, path):
+        hash = new_hash(self.digest_algorithm)
+        with self.backend.open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                hash.update(block)
+        return hash.hexdigest()
+
+    def add_validator(self, validator):
+        """Register a validator for the new files of this transaction.
+
+        Validators are called with the target path and the path of the
+        staged file on the local filesystem, and raise an exception to
+        reject a file. For files created with `compress` this is a
+        decompressed copy. Files which are not stored on the local
+        filesystem are not validated.
+        """
+        self.validators.append(validator)
+
+    def add_progress_callback(self, callback):
+        """Register a function to report the progress of the commit.
+
+        It is called with the number of files committed so far, the total
+        number of files, and the number of bytes moved into place, once
+        before the first file is committed and after each directory.
+        """
+        self.progress_callbacks.append(callback)
 
-    def create_file(self, path, mode):
+    def _report_progress(self, committed, total, moved):
+        for callback in self.progress_callbacks:
+            callback(committed, total, moved)
+
+    def estimate_commit_time(self, plan=None):
+        """Estimate how long committing the vault will take, in seconds.
+
+        The estimate is based on the time other commits in this process
+        needed per file.
+        """
+        if plan is None:
+            plan = self.plan_commit()
+        return _operation_time * sum(len(targets) for (dir, targets) in plan)
+
+    def _check_time_budget(self, start):
+        if self.commit_time_budget is None:
+            return
+        estimate = (time.perf_counter() - start +
+                    self.estimate_commit_time(self.commit_plan))
+        if estimate > self.commit_time_budget:
+            raise CommitTimeBudgetExceeded(estimate, self.commit_time_budget)
+
+    def _staged_size(self, target, info):
+        checksum = self.checksums.get(target)
+        if (checksum is not None and checksum[0] == info["tempfile"] and
+                checksum[1].sequential):
+            return checksum[1].size
+        try:
+            return self.backend.stat(info["tempfile"]).st_size
+        except OSError:
+            return 0
+
+    def _validate(self):
+        """Run all validators over the new files, in parallel.
+
+        Validators get the decompressed data of files created with
+        `compress`, in a temporary copy. The time spent in each validator is
+        stored in `validation_timings`. A `FileValidationError` is raised for
+        the first file that is rejected.
+        """
+        self.validation_timings = timings = {}
+        if not self.validators:
+            return
+        files = []
+        copies = []
+        futures = {}
+        try:
+            for target in self.vault:
+                info = self.vault[target]
+                if (info.get("moved") or info.get("deleted") or
+                        info.get("tree") or info.get("publish")):
+                    continue
+                filename = self.backend.local_path(info["tempfile"])
+                if filename is None:
+                    continue
+                if info.get("compress"):
+                    filename = _decompressed_copy(filename, info["compress"])
+                    copies.append(filename)
+                files.append((target, filename))
+            executor = self.validator_executor or _default_validator_pool()
+            for validator in self.validators:
+                name = getattr(validator, "__name__", repr(validator))
+                timings.setdefault(name, 0.0)
+                for (target, filename) in files:
+                    future = executor.submit(
+                            _run_validator, validator, target, filename)
+                    futures[future] = (name, target)
+            for future in concurrent.futures.as_completed(futures):
+                (name, target) = futures[future]
+                try:
+                    timings[name] += future.result()
+                except Exception as e:
+                    raise FileValidationError(target, name, e) from e
+        finally:
+            for future in futures:
+                future.cancel()
+            # A file was rejected if validators are still running, so their
+            # results no longer matter.
+            for filename in copies:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+    def _exists_function(self, paths):
+        found = self.backend.lookup(paths)
+
+        def exists(path):
+            if path in found:
+                return found[path] is not None
+            return self.backend.exists(path)
+        return exists
+
+    def _claim(self, path):
         if path in self.vault:
             if self.vault[path].get('deleted', False):
                 del self.vault[path]
             else:
                 raise ValueError("%s is already taken", path)
-        file = tempfile.NamedTemporaryFile(
-            mode=mode, dir=self.tempdir, delete=False)
-        self.vault[path] = dict(tempfile=file.name)
-        return file
 
-    def rename_file(self, src, dst, recursive=False):
-        if dst in self.vault:
-            if self.vault[dst].get('deleted', False):
-                del self.vault[dst]
-            else:
-                raise ValueError("%s is already taken", dst)
-        if src not in self.vault and not os.path.exists(src):
+    def _check_budget(self, size_hint):
+        if (size_hint and self.space_budget is not None and
+                self.reserved + size_hint > self.space_budget):
+            raise OSError(errno.ENOSPC,
+                    "Transaction space budget of %d bytes exceeded" %
+                    self.space_budget)
+
+    def _create(self, path, mode, size_hint=None, expected_size=None,
+                expected_digest=None, compress=None):
+        self.usage.add_file()
+        text = compress is not None and "b" not in mode
+        if text:
+            mode = mode.replace("t", "") + "b"
+        (file, staged) = self.backend.stage_file(mode, size_hint)
+        self.vault[path] = info = dict(tempfile=staged)
+        if size_hint:
+            info["size_hint"] = size_hint
+            self.reserved += size_hint
+        checksum = None
+        if self.digest_algorithm is not None or expected_size is not None:
+            checksum = Checksum(self.digest_algorithm)
+            self.checksums[path] = (
+                    staged, checksum, expected_size, expected_digest)
+        file = self.accounted[path] = AccountedFile(
+                file, self.usage, checksum)
+        if compress is None:
+            return file
+        from repoze.filesafe.compression import CompressingWriter
+        info["compress"] = compress
+        file = CompressingWriter(file, compress, self.compression_level,
+                                 self.compression_executor)
+        return io.TextIOWrapper(file) if text else file
+
+    @traced("create_file", ("path", "mode", "size_hint", "expected_size",
+            "expected_digest", "compress"))
+    def create_file(self, path, mode, size_hint=None, expected_size=None,
+                    expected_digest=None, compress=None):
+        """Create a new file.
+
+        If the expected size of the file is passed as `size_hint` disk space
+        is reserved for it up front, and counted against the `space_budget`
+        of the transaction. If there is not enough space an OSError with
+        errno ENOSPC is raised.
+
+        Before the transaction commits the size of the file is compared with
+        the amount of data written to it, and with `expected_size` if given.
+        If `digest_algorithm` is set, the digest of the data is compared with
+        `expected_digest`. A `FileIntegrityError` is raised if they differ.
+
+        If `compress` is ``"gzip"`` or ``"zstd"`` the data is compressed in
+        chunks in a thread pool before it is written, and the file can only
+        be written to. The size and digest checks apply to the compressed
+        data. `open_file` decompresses the file again.
+        """
+        if expected_digest is not None and self.digest_algorithm is None:
+            raise ValueError("expected_digest requires a digest_algorithm")
+        if compress is not None:
+            from repoze.filesafe.compression import compressor
+            compressor(compress)
+            if "+" in mode or "r" in mode:
+                raise ValueError("Compressed files can only be written")
+        self._check_budget(size_hint)
+        if path not in self.vault:
+            self._observe(path)
+        self._claim(path)
+        return self._create(path, mode, size_hint, expected_size,
+                            expected_digest, compress)
+
+    def create_files(self, paths, mode):
+        """Create many files at once.
+
+        Returns a ``(files, errors)`` tuple of dictionaries mapping paths to
+        the new file objects or to the exception raised for that path.
+        """
+        paths = list(paths)
+        found = self.backend.lookup([path for path in paths
+                if path not in self.vault and path not in self.observed])
+        files = {}
+        errors = {}
+        for path in paths:
+            if path in found:
+                self._remember(path, found[path])
+            try:
+                self._claim(path)
+                files[path] = self._create(path, mode)
+            except (OSError, ValueError) as e:
+                errors[path] = e
+        return (files, errors)
+
+    def _rename(self, src, dst, recursive, exists):
+        self._claim(dst)
+        if src not in self.vault and not exists(src):
             raise OSError(
                 errno.ENOENT,
                 "[Errno 2] No such file or directory: '%s'" % src)
         self.vault[dst] = dict(tempfile=src, source=src,
             moved=True, has_original=False, recursive=recursive)
         self.vault[src] = dict(tempfile=src, destination=dst,
-            moved=True, has_original=os.path.exists(src), recursive=recursive)
+            moved=True, has_original=exists(src), recursive=recursive)
+
+    @traced("rename_file", ("src", "dst"))
+    def rename_file(self, src, dst, recursive=False):
+        self._rename(src, dst, recursive, self.backend.exists)
+
+    def rename_files(self, pairs, recursive=False):
+        """Rename many files at once.
+
+        Returns a dictionary mapping source paths to the exception raised
+        while renaming them.
+        """
+        pairs = list(pairs)
+        exists = self._exists_function(
+                [src for (src, dst) in pairs if src not in self.vault])
+        errors = {}
+        for (src, dst) in pairs:
+            try:
+                self._rename(src, dst, recursive, exists)
+            except (OSError, ValueError) as e:
+                errors[src] = e
+        return errors
+
+    @traced("open_file", ("path", "mode", "compress"))
+    def open_file(self, path, mode="r", compress=None):
+        """Open a file, as seen by this transaction.
+
+        Files created with `compress` in this transaction are decompressed
+        automatically. To decompress other files pass their compression
+        format as `compress`.
 
-    def open_file(self, path, mode="r"):
+        Files which are not part of the transaction are opened directly.
+        Files opened for reading are checked for concurrent changes when the
+        transaction commits. Files opened for writing are changed by the
+        caller itself, so they are not checked.
+        """
         if path in self.vault:
             info = self.vault[path]
             if info.get('deleted', False):
                 raise IOError(
                         "[Errno 2] No such file or directory: '%s'" % path)
-            return open(info["tempfile"], mode)
+            compress = info.get("compress", compress)
+            if compress is None:
+                return self.backend.open(info["tempfile"], mode)
+            file = self.backend.open(info["tempfile"], "rb")
+        elif compress is None:
+            file = self.backend.open(path, mode)
+            if any(flag in mode for flag in "wax+"):
+                self.observed.pop(path, None)
+            else:
+                self._remember(path, self.backend.fstat(file, path))
+            return file
         else:
-            return open(path, mode)
+            file = self.backend.open(path, "rb")
+            self._remember(path, self.backend.fstat(file, path))
+        from repoze.filesafe.compression import open_compressed
+        try:
+            return open_compressed(file, compress, mode)
+        except Exception:
+            file.close()
+            raise
 
-    def delete_file(self, path):
+    def _stage_dir(self, path):
+        self._claim(path)
+        staging = self.backend.stage_dir()
+        self.vault[path] = dict(tempfile=staging, tree=True)
+        return staging
+
+    def create_dir(self, path):
+        """Create a new directory.
+
+        Returns the path of a temporary directory which should be filled by
+        the caller. It is moved into place with a single rename when the
+        transaction is committed.
+        """
+        if self.file_exists(path):
+            raise OSError(errno.EEXIST,
+                    "[Errno 17] File exists: '%s'" % path)
+        return self._stage_dir(path)
+
+    def replace_dir(self, path):
+        """Create or replace a directory.
+
+        This works like `create_dir`, but an existing directory is replaced
+        as a whole when the transaction is committed. Other files can not be
+        replaced with a directory.
+        """
+        if (path not in self.vault and self.backend.lexists(path) and
+                not self.backend.isdir(path)):
+            raise OSError(errno.ENOTDIR,
+                    "[Errno 20] Not a directory: '%s'" % path)
+        return self._stage_dir(path)
+
+    def delete_tree(self, path):
+        """Delete a directory and everything in it.
+
+        When the transaction is committed the directory is renamed out of
+        the way. It is only removed after the transaction has finished.
+        """
+        if path in self.vault:
+            self._delete(path, self.backend.isdir)
+            return
+        if not self.backend.isdir(path):
+            raise OSError(errno.ENOENT,
+                    "[Errno 2] No such file or directory: '%s'" % path)
+        self.vault[path] = dict(tempfile=path, deleted=True, tree=True)
+
+    def publish_dir(self, link_path, keep=1):
+        """Publish a new generation of a directory behind a symbolic link.
+
+        Returns the path of a new directory next to `link_path` which should
+        be filled by the caller. When the transaction is committed
+        `link_path` is atomically changed to point to it. The `keep` most
+        recent previous generations are kept, everything older is removed
+        after the transaction has finished.
+        """
+        backend = self.backend
+        if backend.lexists(link_path) and not backend.islink(link_path):
+            raise ValueError("%s is not a symbolic link" % link_path)
+        self._claim(link_path)
+        (directory, name) = os.path.split(link_path)
+        now = time.time()
+        stamp = "%s%06d-" % (time.strftime("%Y%m%d%H%M%S", time.gmtime(now)),
+                (now % 1) * 1000000)
+        staging = backend.make_dir(directory, _generation_prefix(name) + stamp)
+        self.vault[link_path] = dict(tempfile=staging, publish=True, keep=keep)
+        return staging
+
+    def _commit_publish(self, target, info):
+        if self.backend.islink(target):
+            info["previous"] = self.backend.readlink(target)
+            info["has_original"] = True
+        else:
+            info["has_original"] = False
+        self._replace_link(target, os.path.basename(info["tempfile"]))
+        info["moved"] = True
+
+    def _replace_link(self, link_path, target):
+        tmp = link_path + self.backup_suffix
+        self.backend.symlink(target, tmp)
+        self.backend.rename(tmp, link_path)
+
+    def _abort_publish(self, target, info):
+        if info.get("moved"):
+            if info["has_original"]:
+                self._replace_link(target, info["previous"])
+            else:
+                self.backend.unlink(target)
+
+    def _lock_history(self, history):
+        """Open and lock the generation history of a link.
+
+        The history is replaced when generations expire, so the lock is only
+        kept if the file was not replaced while waiting for it.
+        """
+        while True:
+            f = self.backend.open(history, "a+")
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                current = self.backend.stat(history)
+            except OSError:
+                current = None
+            opened = self.backend.fstat(f, history)
+            if current is not None and current.st_ino == opened.st_ino:
+                return f
+            f.close()
+
+    def _expired_generations(self, target, info):
+        """Return the published generations which are no longer kept.
+
+        The new generation is added to the history of the link and the
+        expired ones are removed from it. Only generations which were
+        published can expire, not the staging directories of other
+        transactions.
+        """
+        directory = os.path.dirname(target)
+        history = _generation_history(target)
+        current = os.path.basename(info["tempfile"])
+        previous = info.get("previous")
+        with self._lock_history(history) as f:
+            f.seek(0)
+            published = f.read().split()
+            present = set(self.backend.listdir(directory))
+            generations = []
+            for entry in reversed(published):
+                if (entry in present and entry != current and
+                        entry not in generations):
+                    generations.append(entry)
+            if previous in generations:
+                generations.remove(previous)
+                generations.insert(0, previous)
+            (kept, expired) = (generations[:info["keep"]],
+                               generations[info["keep"]:])
+            if not expired:
+                f.write(current + "\n")
+                return []
+            tmp = history + self.backup_suffix
+            with self.backend.open(tmp, "w") as new:
+                new.writelines("%s\n" % entry
+                               for entry in kept[::-1] + [current])
+            self.backend.rename(tmp, history)
+        return [os.path.join(directory, entry) for entry in expired]
+
+    def map_file(self, path):
+        """Return a read-only memory map of a file.
+
+        Mappings which are still open are closed before the transaction
+        commits. Empty files can not be mapped, so an empty memoryview is
+        returned for them.
+        """
+        if path in self.vault:
+            info = self.vault[path]
+            if info.get('deleted', False):
+                raise IOError(
+                        "[Errno 2] No such file or directory: '%s'" % path)
+            filename = info["tempfile"]
+        else:
+            filename = path
+        (mapping, st) = self.backend.map(filename)
+        if path not in self.vault:
+            self._remember(path, st)
+        if isinstance(mapping, mmap.mmap):
+            self.mappings.add(mapping)
+        return mapping
+
+    def _delete(self, path, exists):
         if path in self.vault:
             info = self.vault[path]
             if info.get('deleted', False):
                 raise OSError(errno.ENOENT,
                         "[Errno 2] No such file or directory: '%s'" % path)
             try:
-                os.unlink(info["tempfile"])
+                if info.get("tree", False):
+                    self.backend.remove_tree(info["tempfile"])
+                else:
+                    self.backend.unlink(info["tempfile"])
             except OSError:
                 # XXX log.exception makes the testruns die with an exception
                 # in multiprocessing.util:258
                 #log.exception("Failed to delete temporary file %s", target)
                 pass
+            self.reserved -= info.get("size_hint", 0)
+            self.checksums.pop(path, None)
+            accounted = self.accounted.pop(path, None)
+            if accounted is not None:
+                accounted.discharge()
             del self.vault[path]
         else:
-            if not os.path.exists(path):
+            if not exists(path):
                 raise OSError(errno.ENOENT,
                         "[Errno 2] No such file or directory: '%s'" % path)
             self.vault[path] = dict(tempfile=path, deleted=True)
 
+    @traced("delete_file", ("path",))
+    def delete_file(self, path):
+        self._delete(path, self.backend.exists)
+
+    def delete_files(self, paths):
+        """Delete many files at once.
+
+        Returns a dictionary mapping paths to the exception raised while
+        deleting them.
+        """
+        paths = list(paths)
+        exists = self._exists_function(
+                [path for path in paths if path not in self.vault])
+        errors = {}
+        for path in paths:
+            try:
+                self._delete(path, exists)
+            except OSError as e:
+                errors[path] = e
+        return errors
+
     def file_exists(self, path):
         if path in self.vault:
             info = self.vault[path]
             deleted = info.get('deleted', False)
             moved = info.get('moved', False) and 'destination' in info
             return not (deleted or moved)
-        return os.path.exists(path)
+        try:
+            st = self.backend.stat(path)
+        except OSError:
+            self._remember(path, None)
+            return False
+        self._remember(path, st)
+        return True
 
     def file_path(self, path):
         if not self.file_exists(path):
@@ -97,47 +825,196 @@ class FileSafeDataManager:
             return info["tempfile"]
         return path
 
+    def plan_commit(self):
+        """Return the order in which the vault will be committed.
+
+        Returns a list of ``(directory, targets)`` batches, which `commit`
+        handles one by one. After `commit` the plan it used is available as
+        `commit_plan`.
+        """
+        return plan_commit((target, self.vault[target])
+                           for target in self.vault)
+
+    def _planned(self):
+        if self.commit_plan is None:
+            return self.vault
+        return [target for (directory, targets) in self.commit_plan
+                for target in targets]
+
+    @traced("tpc_begin")
     def tpc_begin(self, transaction):
         pass
 
+    @traced("commit")
     def commit(self, transaction):
+        # The transaction package calls tpc_vote only after commit, but
+        # commit already moves files around, so conflicts, checksums and
+        # validators are checked here, as well as the time budget.
+        start = time.perf_counter()
+        self.commit_plan = self.plan_commit()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Commit plan: %r", self.commit_plan)
+        # Directories are only opened now, so files are committed to the
+        # directories which are there when the transaction commits, and not
+        # to directories another transaction replaced in the meantime.
+        moved = self.backend.open_dirs(
+                [directory for (directory, targets) in self.commit_plan])
+        if moved:
+            raise FileConflictError(moved[0])
+        self._check_conflicts()
+        self._verify_checksums()
+        self._validate()
+        self._check_time_budget(start)
+        self._release_mappings()
+        if self.reserved:
+            self._trim_staged()
+        if self.sync_directories:
+            self._sync_staged()
+        total = sum(len(targets) for (directory, targets) in self.commit_plan)
+        self._report_progress(0, total, 0)
+        start = time.perf_counter()
         self.in_commit = True
-        for target in self.vault:
+        # Originals are moved out of the way under a name of their own, so
+        # backups of other transactions do not get in the way.
+        self.backup_suffix = ".filesafe-%s" % os.urandom(4).hex()
+        changed = set()
+        committed = moved = 0
+        for (directory, targets) in self.commit_plan:
+            (dirs, size) = self._commit_batch(directory, targets)
+            changed.update(dirs)
+            committed += len(targets)
+            moved += size
+            self._report_progress(committed, total, moved)
+        if self.sync_directories:
+            self.backend.sync_dirs(sorted(changed))
+        _record_commit_time(total, time.perf_counter() - start)
+
+    def _trim_staged(self):
+        """Release the space reserved with size hints which was not used."""
+        self.backend.trim_files([info["tempfile"]
+                for info in (self.vault[target] for target in self.vault)
+                if info.get("size_hint")])
+
+    def _sync_staged(self):
+        """Flush the data of new files and directories to disk.
+
+        Otherwise a crash could leave renamed files without their data.
+        """
+        paths = []
+        for target in self._planned():
+            info = self.vault[target]
+            if not (info.get("deleted") or "source" in info or
+                    "destination" in info):
+                paths.append(info["tempfile"])
+        self.backend.sync_files(paths)
+
+    def _commit_batch(self, directory, targets):
+        """Commit the targets in a directory.
+
+        Returns the directories which were changed, and the number of bytes
+        moved into place if there are progress callbacks.
+        """
+        changed = set([directory])
+        moved = 0
+        for target in targets:
+            # Entries of a SpillVault are only written back while they are
+            # cached, so change them right after getting them.
             info = self.vault[target]
             if info.get('moved', False) and 'destination' in info:
                 continue
-            if info.get("deleted", False):
-                os.rename(target, "%s.filesafe" % target)
+            if "source" in info:
+                changed.add(os.path.dirname(info["source"]))
+            elif self.progress_callbacks and not (info.get("tree") or
+                    info.get("deleted") or info.get("publish")):
+                moved += self._staged_size(target, info)
+            if info.get("publish"):
+                self._commit_publish(target, info)
+            elif info.get("deleted", False):
+                info["backup"] = target + self.backup_suffix
+                self.backend.rename(target, info["backup"])
                 info["has_original"] = True
                 info["moved"] = True
+            elif (self.use_renameat2 and 'source' not in info and
+                    self._commit_renameat2(target, info)):
+                continue
             else:
-                if os.path.exists(target):
+                if self.backend.exists(target):
                     info["has_original"] = True
-                    os.link(target, "%s.filesafe" % target)
+                    info["backup"] = target + self.backup_suffix
+                    if info.get("tree"):
+                        # Directories can not be hardlinked
+                        self.backend.rename(target, info["backup"])
+                    else:
+                        self.backend.link(target, info["backup"])
                 else:
                     info["has_original"] = False
-                rename = os.renames if info.get("recursive") else os.rename
-                rename(info["tempfile"], target)
+                self.backend.rename(info["tempfile"], target,
+                        info.get("recursive", False))
                 info["moved"] = True
+        return (changed, moved)
+
+    def _commit_renameat2(self, target, info):
+        """Move a staged file into place with renameat2.
 
+        An existing target is swapped with the staged file, leaving the
+        original at the staging path. Files which did not exist when the
+        transaction looked at them are created without replacing anything,
+        so a concurrently created target is detected.
+        Returns False if renameat2 can not be used for this file.
+        """
+        if self.observed.get(target, True) is not None:
+            try:
+                self.backend.exchange(info["tempfile"], target)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    if e.errno in (errno.ENOSYS, errno.EINVAL):
+                        return False
+                    raise
+            else:
+                info["has_original"] = True
+                info["exchanged"] = True
+                info["moved"] = True
+                return True
+        try:
+            self.backend.rename_noreplace(info["tempfile"], target)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise FileConflictError(target)
+            if e.errno in (errno.ENOSYS, errno.EINVAL):
+                return False
+            raise
+        info["has_original"] = False
+        info["moved"] = True
+        return True
+
+    @traced("tpc_vote")
     def tpc_vote(self, transaction):
         pass
 
+    @traced("tpc_finish")
     def tpc_finish(self, transaction):
-        for target in self.vault:
+        trash = []
+        for target in self._planned():
             info = self.vault[target]
-            if info.get("deleted", False):
+            if info.get("publish"):
                 try:
-                    os.unlink("%s.filesafe" % info["tempfile"])
+                    trash.extend(self._expired_generations(target, info))
                 except OSError:
-                    # XXX log.exception makes the testruns die with an
-                    # exception in multiprocessing.util:258
-                    # log.exception("Failed to remove file backup for %s",
-                    # target)
                     pass
-            elif info.get("has_original"):
+            elif info.get("exchanged"):
+                # The original now lives at the staging path
+                if info.get("tree"):
+                    trash.append(info["tempfile"])
+                else:
+                    try:
+                        self.backend.unlink(info["tempfile"])
+                    except OSError:
+                        pass
+            elif info.get("tree") and "backup" in info:
+                trash.append(info["backup"])
+            elif "backup" in info:
                 try:
-                    os.unlink("%s.filesafe" % target)
+                    self.backend.unlink(info["backup"])
                 except OSError:
                     # XXX log.exception makes the testruns die with an
                     # exception in multiprocessing.util:258
@@ -145,30 +1022,67 @@ class FileSafeDataManager:
                     # target)
                     pass
 
+        trash.extend(self.backend.release())
         self.in_commit = False
-        self._cleanup()
+        self._cleanup(transaction)
+        self.backend.discard(trash)
 
+    @traced("tpc_abort")
     def tpc_abort(self, transaction):
-        for target in self.vault:
+        self.digests = {}
+        trash = []
+        # Undo the commit in reverse order.
+        planned = self._planned()
+        if self.commit_plan is not None:
+            planned.reverse()
+        for target in planned:
             info = self.vault[target]
-            if info.get("moved"):
+            if info.get("publish"):
+                trash.append(info["tempfile"])
+                try:
+                    self._abort_publish(target, info)
+                except OSError:
+                    pass
+                continue
+            tree = info.get("tree", False) and not info.get("deleted", False)
+            if tree and not self.backend.is_staged(info["tempfile"]):
+                trash.append(info["tempfile"])
+            if info.get("exchanged"):
+                try:
+                    self.backend.exchange(info["tempfile"], target)
+                except OSError:
+                    pass
+            elif info.get("moved"):
                 try:
+                    if tree:
+                        # Move the new directory back to its staging area.
+                        self.backend.rename(target, info["tempfile"])
                     if info["has_original"]:
-                        os.rename("%s.filesafe" % target, target)
+                        # Sources of renames are moved back with their
+                        # destination and have no backup.
+                        if "backup" in info:
+                            self.backend.rename(info["backup"], target)
                     elif 'source' in info:
-                        rename = os.renames if info.get("recursive") else os.rename
-                        rename(target, info["source"])
-                    else:
-                        os.unlink(target)
+                        self.backend.rename(target, info["source"],
+                                info.get("recursive", False))
+                    elif not tree:
+                        self.backend.unlink(target)
                 except OSError:
                     # XXX log.exception makes the testruns die with an
                     # exception in multiprocessing.util:258
                     # log.exception("Failed to restore original file %s",
                     # target)
                     pass
-            else:
+            elif tree and "backup" in info:
+                # Commit failed after the old directory was moved away
+                try:
+                    self.backend.rename(info["backup"], target)
+                except OSError:
+                    pass
+            elif not (tree or info.get("deleted", False) or
+                    self.backend.is_staged(info["tempfile"])):
                 try:
-                    os.unlink(info["tempfile"])
+                    self.backend.unlink(info["tempfile"])
                 except OSError:
                     # XXX log.exception makes the testruns die with an
                     # exception in multiprocessing.util:258
@@ -176,8 +1090,12 @@ class FileSafeDataManager:
                     # target)
                     pass
 
+        # Staged files and directories are all removed at once with the
+        # staging directory.
+        trash.extend(self.backend.release(aborted=True))
         self.in_commit = False
-        self._cleanup()
+        self._cleanup(transaction)
+        self.backend.discard(trash)
 
     abort = tpc_abort
 
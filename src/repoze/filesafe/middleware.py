@@ -0,0 +1,136 @@
+# WSGI middleware. FileSafeMiddleware is deprecated, and only kept for
+# backwards compatibility.
+import io
+import warnings
+from urllib.parse import urlencode
+
+
+class FileSafeMiddleware(object):
+    def __init__(self, app, config=None, **kwargs):
+        self.app = app
+        warnings.warn('FileSafeMiddleware is no longer required. You can '
+                      'safely remove it.',
+                      DeprecationWarning, stacklevel=2)
+
+    def __call__(self, environ, start_response):
+        # Join the data manager to the transaction, as earlier versions did.
+        from repoze.filesafe import get_manager
+        get_manager()
+        return self.app(environ, start_response)
+
+
+def filesafe_filter_factory(global_conf, **kwargs):
+    def filter(app):
+        return FileSafeMiddleware(app, global_conf, **kwargs)
+    return filter
+
+
+def filesafe_filter_app_factory(app, global_conf, **kwargs):
+    return FileSafeMiddleware(app, global_conf, **kwargs)
+
+
+class FileSafeUploadMiddleware(object):
+    """Stage files uploaded with multipart/form-data POST requests.
+
+    The request body is parsed with `parse_multipart`, which writes uploaded
+    files directly to files staged in the current transaction. The result is
+    stored in the ``repoze.filesafe.uploads`` key of the WSGI environment as
+    a ``(fields, files)`` tuple. The normal form fields are passed on to the
+    application as an ``application/x-www-form-urlencoded`` request body.
+    Requests which can not be parsed are refused with a 400 response.
+
+    Inside a transaction middleware which sets ``repoze.tm.active``, such as
+    repoze.tm2, uploads are staged in its transaction. Otherwise the
+    middleware runs the request in a transaction of its own, which is
+    committed unless the application fails or returns an error status. An
+    application which begins another transaction would silently drop the
+    uploads, so a `RuntimeError` is raised in that case.
+    """
+
+    def __init__(self, app, destination, transaction_manager=None,
+                 **options):
+        self.app = app
+        self.destination = destination
+        self.transaction_manager = transaction_manager
+        self.options = options
+
+    def __call__(self, environ, start_response):
+        content_type = environ.get("CONTENT_TYPE", "")
+        if (environ.get("REQUEST_METHOD") != "POST" or
+                not content_type.startswith("multipart/form-data")):
+            return self.app(environ, start_response)
+        tm = self.transaction_manager
+        if tm is None:
+            import transaction
+            tm = transaction.manager
+        if environ.get("repoze.tm.active"):
+            return self._handle(environ, start_response, tm)
+        tx = tm.begin()
+        statuses = []
+
+        def _start_response(status, headers, *exc_info):
+            statuses.append(status)
+            return start_response(status, headers, *exc_info)
+        try:
+            result = self._handle(environ, _start_response, tm)
+            try:
+                current = tm.get()
+            except Exception:
+                current = None
+            if current is not tx:
+                raise RuntimeError("The transaction of the uploads was "
+                        "replaced. Place FileSafeUploadMiddleware inside "
+                        "the transaction middleware.")
+        except Exception:
+            tm.abort()
+            raise
+        if tx.isDoomed() or not statuses or statuses[-1][:1] not in "23":
+            tm.abort()
+        else:
+            tm.commit()
+        return result
+
+    def _handle(self, environ, start_response, tm):
+        from repoze.filesafe import get_manager
+        from repoze.filesafe.uploads import MultipartError
+        from repoze.filesafe.uploads import parse_multipart
+        try:
+            (fields, files) = parse_multipart(
+                    environ, self.destination, get_manager(tm),
+                    **self.options)
+        except MultipartError as e:
+            body = str(e).encode("utf-8")
+            start_response("400 Bad Request",
+                           [("Content-Type", "text/plain; charset=utf-8"),
+                            ("Content-Length", str(len(body)))])
+            return [body]
+        body = urlencode([(name, value) for (name, values) in fields.items()
+                          for value in values]).encode("ascii")
+        environ["repoze.filesafe.uploads"] = (fields, files)
+        environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ["wsgi.input"] = io.BytesIO(body)
+        return self.app(environ, start_response)
+
+
+def _upload_options(directory, chunk_size=None, max_field_size=None):
+    from repoze.filesafe.uploads import unique_destination
+    options = {}
+    if chunk_size is not None:
+        options["chunk_size"] = int(chunk_size)
+    if max_field_size is not None:
+        options["max_field_size"] = int(max_field_size)
+    return (unique_destination(directory), options)
+
+
+def upload_filter_factory(global_conf, directory, **kwargs):
+    (destination, options) = _upload_options(directory, **kwargs)
+
+    def filter(app):
+        return FileSafeUploadMiddleware(app, destination, **options)
+    return filter
+
+
+def upload_filter_app_factory(app, global_conf, directory, **kwargs):
+    (destination, options) = _upload_options(directory, **kwargs)
+    return FileSafeUploadMiddleware(app, destination, **options)
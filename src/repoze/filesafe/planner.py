@@ -0,0 +1,95 @@
+"""Order the operations of a commit by directory.
+
+The vault of a data manager is kept in the order in which files were
+handled, so committing it in that order jumps between directories. The
+planner groups the operations per parent directory instead, so every
+directory is visited once, while making sure that
+
+* a new directory or a directory which is moved into place is committed
+  before anything inside it, and
+* everything inside a directory which is deleted or moved away is committed
+  before the directory itself.
+"""
+import heapq
+import os.path
+
+
+def _ancestors(path):
+    while True:
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return
+        yield parent
+        path = parent
+
+
+def _depth(path):
+    return len([part for part in path.split(os.sep) if part])
+
+
+def plan_commit(operations):
+    """Return the order in which to commit the entries of a vault.
+
+    `operations` is an iterable of ``(target, info)`` tuples in vault order.
+    Returns a list of ``(directory, targets)`` batches. Batches are ordered
+    so that parent directories come first, and the targets of a batch are
+    sorted by name. Operations which can not be ordered, for example
+    because of circular renames, are kept in vault order at the end.
+    """
+    targets = []
+    # Paths which appear, and paths which disappear, during the commit.
+    created = {}
+    removed = {}
+    for (seq, (target, info)) in enumerate(operations):
+        targets.append((target, info.get("source")))
+        if info.get("deleted"):
+            removed.setdefault(target, []).append(seq)
+        elif "destination" not in info:
+            created[target] = seq
+            if "source" in info:
+                removed.setdefault(info["source"], []).append(seq)
+
+    after = [[] for target in targets]
+    waiting = [0] * len(targets)
+    for (seq, (target, source)) in enumerate(targets):
+        for parent in _ancestors(target):
+            if parent in created and created[parent] != seq:
+                after[created[parent]].append(seq)
+                waiting[seq] += 1
+        for path in (target, source):
+            if path is None:
+                continue
+            for parent in _ancestors(path):
+                for other in removed.get(parent, ()):
+                    if other != seq:
+                        after[seq].append(other)
+                        waiting[other] += 1
+
+    def key(seq):
+        target = targets[seq][0]
+        directory = os.path.dirname(target)
+        return (_depth(directory), directory, target, seq)
+
+    ready = [key(seq) for seq in range(len(targets)) if not waiting[seq]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        seq = heapq.heappop(ready)[-1]
+        order.append(seq)
+        for other in after[seq]:
+            waiting[other] -= 1
+            if not waiting[other]:
+                heapq.heappush(ready, key(other))
+    if len(order) < len(targets):
+        done = set(order)
+        order.extend(seq for seq in range(len(targets)) if seq not in done)
+
+    batches = []
+    for seq in order:
+        target = targets[seq][0]
+        directory = os.path.dirname(target)
+        if batches and batches[-1][0] == directory:
+            batches[-1][1].append(target)
+        else:
+            batches.append((directory, [target]))
+    return batches
@@ -0,0 +1,17 @@
+"""pytest fixtures for code which uses repoze.filesafe.
+
+This plugin is registered automatically when repoze.filesafe is installed.
+"""
+import pytest
+from repoze.filesafe.testing import dummy_data_manager
+
+
+@pytest.fixture
+def filesafe_manager():
+    """Keep all files created through repoze.filesafe in memory.
+
+    Yields the `DummyDataManager`. Its `data` attribute maps paths to the
+    files which were created.
+    """
+    with dummy_data_manager() as manager:
+        yield manager
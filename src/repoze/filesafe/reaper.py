@@ -0,0 +1,211 @@
+"""Clean up files left behind by crashed or failed transactions.
+
+Three kinds of leftovers are handled:
+
+* staging directories (``filesafe-<pid>-<thread>-<id>-...``) in the temporary
+  directory, left behind if a process died during a transaction;
+* vault databases (``filesafe-vault-<pid>-...``) of a `SpillVault`, in the
+  same directory and for the same reason;
+* ``<path>.filesafe-<token>`` backups next to target files, left behind if a
+  process died during commit, or if removing the backup failed. Versions
+  before 3.0 used ``<path>.filesafe``, which is recognized as well.
+"""
+import argparse
+import errno
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+log = logging.getLogger("repoze.filesafe")
+
+_staging_name = re.compile(r"^filesafe-(\d+)-\d+-[0-9a-f]+-")
+_vault_name = re.compile(r"^filesafe-vault-(\d+)-")
+_backup_name = re.compile(r"\.filesafe(-[0-9a-f]{8})?$")
+
+
+class ReapReport(object):
+    """Summary of what `reap` did."""
+
+    def __init__(self):
+        self.removed = []
+        self.restored = []
+        self.bytes = 0
+
+    def __str__(self):
+        return "Removed %d, restored %d, reclaimed %d bytes" % (
+                len(self.removed), len(self.restored), self.bytes)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _process_started(pid):
+    """Return the time a process started, if the system can tell."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            # The command name may contain spaces, but not a closing parens.
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            boot = [int(line.split()[1]) for line in f
+                    if line.startswith("btime ")][0]
+        return boot + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _disk_usage(path):
+    st = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return st.st_size
+    total = st.st_size
+    for (directory, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def find_orphans(tempdir=None, roots=(), max_age=3600, now=None):
+    """Find leftovers which are safe to clean up.
+
+    Staging directories in `tempdir` are stale if the process which created
+    them no longer exists, and so are the vault databases of such
+    processes. The age of a staging directory says nothing about its owner,
+    since it does not change while data is written to a file in it, so it is
+    only used to detect reused process ids: a directory which has not been
+    changed for `max_age` seconds, and is older than the process which has
+    its id, is stale as well. Backups below the directories in `roots` are
+    stale once they are `max_age` seconds old. Yields ``(kind, path)``
+    tuples, where `kind` is ``'staging'``, ``'vault'`` or ``'backup'``.
+    """
+    if tempdir is None:
+        tempdir = tempfile.gettempdir()
+    if now is None:
+        now = time.time()
+    try:
+        entries = os.listdir(tempdir)
+    except OSError:
+        entries = []
+    for name in entries:
+        kind = 'staging'
+        match = _staging_name.match(name)
+        if match is None:
+            kind = 'vault'
+            match = _vault_name.match(name)
+        if match is None:
+            continue
+        path = os.path.join(tempdir, name)
+        try:
+            changed = os.lstat(path).st_ctime
+        except OSError:
+            continue
+        pid = int(match.group(1))
+        if not _process_alive(pid):
+            yield (kind, path)
+        elif now - changed > max_age:
+            started = _process_started(pid)
+            if started is not None and started > changed:
+                yield (kind, path)
+
+    for root in roots:
+        for (directory, dirs, files) in os.walk(root):
+            for name in dirs + files:
+                if _backup_name.search(name) is None:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    # The change time is updated when a backup is created,
+                    # the modification time belongs to the original data.
+                    age = now - os.lstat(path).st_ctime
+                except OSError:
+                    continue
+                if age > max_age:
+                    yield ('backup', path)
+            dirs[:] = [name for name in dirs
+                       if _backup_name.search(name) is None]
+
+
+def reap(tempdir=None, roots=(), max_age=3600, limit=None, rate=None,
+         restore=False, dry_run=False):
+    """Remove stale staging directories, vault databases and backups.
+
+    Backups are removed. If `restore` is true a backup whose original path
+    no longer exists is moved back into place instead, for leftovers of
+    transactions which did not commit. Do not use this if transactions may
+    have deleted files: their backups are left behind as well if removing
+    them failed, and would be restored. At most `limit` leftovers are
+    handled per call, and no more than `rate` per second, so large volumes
+    can be cleaned up incrementally. Returns a `ReapReport`.
+    """
+    report = ReapReport()
+    interval = 1.0 / rate if rate else 0
+    orphans = find_orphans(tempdir, roots, max_age)
+    for (count, (kind, path)) in enumerate(orphans):
+        if limit is not None and count >= limit:
+            break
+        if count and interval:
+            time.sleep(interval)
+        try:
+            target = None
+            if kind == 'backup':
+                target = _backup_name.sub("", path)
+            if target and restore and not os.path.lexists(target):
+                if not dry_run:
+                    os.rename(path, target)
+                report.restored.append(path)
+                log.info("Restored %s", target)
+            else:
+                size = _disk_usage(path)
+                if not dry_run:
+                    _remove(path)
+                report.removed.append(path)
+                report.bytes += size
+                log.info("Removed %s", path)
+        except OSError:
+            log.exception("Failed to clean up %s", path)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Clean up files left behind by repoze.filesafe.")
+    parser.add_argument("roots", metavar="ROOT", nargs="*",
+            help="Directory to search for stale backups")
+    parser.add_argument("--tempdir",
+            help="Temporary directory used for staging files")
+    parser.add_argument("--max-age", type=float, default=3600,
+            help="Minimum age in seconds (default: %(default)s)")
+    parser.add_argument("--limit", type=int,
+            help="Maximum number of leftovers to handle")
+    parser.add_argument("--rate", type=float,
+            help="Maximum number of leftovers to handle per second")
+    parser.add_argument("--restore", action="store_true",
+            help="Restore backups of missing files instead of removing them")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+            help="Only report what would be done")
+    options = parser.parse_args(argv)
+    report = reap(options.tempdir, options.roots, options.max_age,
+            options.limit, options.rate, options.restore, options.dry_run)
+    for path in report.restored:
+        print("restored %s" % path)
+    for path in report.removed:
+        print("removed %s" % path)
+    print(report)
+    return 0
@@ -1,33 +1,148 @@
 import errno
+import hashlib
+import io
 import os
 import shutil
 import tempfile
+import time
 import unittest
+from repoze.filesafe.backends import LocalBackend
 from repoze.filesafe.manager import FileSafeDataManager
 from repoze.filesafe.testing import DummyDataManager
 from repoze.filesafe.testing import MockBytesIO
 from repoze.filesafe.testing import MockStringIO
 
 
+def wait_for_removals():
+    from repoze.filesafe.backends import _removals
+    _removals.join()
+
+
 class Test_get_manager(unittest.TestCase):
 
     def tearDown(self):
+        import transaction
         from repoze.filesafe import _remove_manager
         _remove_manager()
+        transaction.abort()
 
     def _callFUT(self, *a, **kw):
-        from repoze.filesafe import _get_manager
-        return _get_manager(*a, **kw)
+        from repoze.filesafe import get_manager
+        return get_manager(*a, **kw)
 
     def test_full_cycle(self):
         import transaction
-        from repoze.filesafe import _local
-        self.assertTrue(not hasattr(_local, 'manager'))
         mgr = self._callFUT()
         self.assertTrue(isinstance(mgr, FileSafeDataManager))
-        self.assertTrue(_local.manager is mgr)
+        self.assertTrue(self._callFUT() is mgr)
+        self.assertTrue(mgr.transaction_manager is transaction.manager)
+        self.assertTrue(mgr in transaction.get()._resources)
         transaction.get().abort()
-        self.assertTrue(not hasattr(_local, 'manager'))
+        self.assertTrue(self._callFUT() is not mgr)
+
+    def test_manager_per_transaction_after_commit(self):
+        import transaction
+        mgr = self._callFUT()
+        transaction.commit()
+        self.assertTrue(self._callFUT() is not mgr)
+
+    def test_explicit_transaction_manager(self):
+        import transaction
+        tempdir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(tempdir, "greeting")
+            tm = transaction.TransactionManager(explicit=True)
+            tm.begin()
+            mgr = self._callFUT(tm)
+            self.assertTrue(mgr.transaction_manager is tm)
+            self.assertTrue(self._callFUT(tm) is mgr)
+            self.assertTrue(self._callFUT() is not mgr)
+            f = mgr.create_file(target, "w")
+            f.write("Hello")
+            f.close()
+            tm.commit()
+            self.assertEqual(open(target).read(), "Hello")
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_pinned_manager_is_context_local(self):
+        import contextvars
+        from repoze.filesafe.testing import setup_dummy_data_manager
+        ctx = contextvars.copy_context()
+        dummy = ctx.run(setup_dummy_data_manager)
+        self.assertTrue(ctx.run(self._callFUT) is dummy)
+        self.assertTrue(self._callFUT() is not dummy)
+
+
+class ImportTests(unittest.TestCase):
+
+    def _import_times(self, statement):
+        import subprocess
+        import sys
+        import repoze.filesafe
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(repoze.filesafe.__file__))))
+        output = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c", statement],
+            stderr=subprocess.STDOUT, env=env, universal_newlines=True)
+        times = {}
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            (self_time, cumulative, name) = line[12:].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+        return times
+
+    def test_import_is_lazy(self):
+        times = self._import_times("import repoze.filesafe")
+        self.assertTrue("repoze.filesafe" in times)
+        for name in ["transaction", "zope.interface", "six", "tempfile",
+                     "repoze.filesafe.manager", "repoze.filesafe.middleware",
+                     "repoze.filesafe.testing"]:
+            if name == "tempfile" and "pkg_resources" in times:
+                # The namespace package declaration imports it as well
+                continue
+            self.assertFalse(name in times, "%s was imported" % name)
+        # Time spent in repoze.filesafe itself, in microseconds
+        own = times["repoze.filesafe"] - times.get("repoze", 0)
+        self.assertTrue(own < 50000, "import took %d usec" % own)
+
+    def test_lazy_attributes(self):
+        import repoze.filesafe
+        from repoze.filesafe import manager
+        from repoze.filesafe import middleware
+        self.assertTrue(repoze.filesafe.FileSafeDataManager is
+                        manager.FileSafeDataManager)
+        self.assertTrue(repoze.filesafe.FileConflictError is
+                        manager.FileConflictError)
+        self.assertTrue(repoze.filesafe.filesafe_filter_factory is
+                        middleware.filesafe_filter_factory)
+        self.assertRaises(AttributeError, getattr, repoze.filesafe, "bogus")
+
+
+class FileSafeMiddlewareTests(unittest.TestCase):
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def test_joins_manager(self):
+        import transaction
+        import warnings
+        from repoze.filesafe.middleware import FileSafeMiddleware
+        seen = []
+
+        def app(environ, start_response):
+            seen.append(transaction.get().data(FileSafeDataManager))
+            return [b"ok"]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            middleware = FileSafeMiddleware(app)
+        transaction.begin()
+        self.assertEqual(middleware({}, None), [b"ok"])
+        self.failUnless(isinstance(seen[0], FileSafeDataManager))
 
 
 class Test_create_file(unittest.TestCase):
@@ -44,10 +159,12 @@ class Test_create_file(unittest.TestCase):
         test_tempdir = tempfile.mkdtemp()
         try:
             newfile = self._callFUT("tst", "w", test_tempdir)
-            self.assertEqual(os.path.dirname(newfile.name), test_tempdir)
+            stagedir = os.path.dirname(newfile.name)
+            self.assertEqual(os.path.dirname(stagedir), test_tempdir)
             self.failUnless(callable(newfile.read))
             self.failUnless(callable(newfile.write))
         finally:
+            wait_for_removals()
             shutil.rmtree(test_tempdir)
 
 
@@ -68,6 +185,7 @@ class FileSafeDataManagerTests(unittest.TestCase):
         self.dm = self.DM(self.tempdir)
 
     def tearDown(self):
+        wait_for_removals()
         shutil.rmtree(self.tempdir)
 
     def test_create_file(self):
@@ -122,7 +240,9 @@ class FileSafeDataManagerTests(unittest.TestCase):
         self.assertEqual(dm.vault[target]["moved"], True)
         self.assertEqual(dm.vault[target]["has_original"], True)
         self.assertEqual(self.open(target).read(), "Hello, World!")
-        self.assertEqual(self.exists("%s.filesafe" % target), True)
+        backup = dm.vault[target]["backup"]
+        self.assertTrue(backup.startswith("%s.filesafe-" % target))
+        self.assertEqual(self.open(backup).read(), "...---...")
 
     def test_finish_without_originals(self):
         dm = self.dm
@@ -134,10 +254,11 @@ class FileSafeDataManagerTests(unittest.TestCase):
     def test_finish_with_original(self):
         dm = self.dm
         target = os.path.join(self.tempdir, "greeting")
-        self.open("%s.filesafe" % target, "w").close()
-        dm.vault = {target: dict(has_original=True)}
+        backup = "%s.filesafe-1234" % target
+        self.open(backup, "w").close()
+        dm.vault = {target: dict(has_original=True, backup=backup)}
         dm.tpc_finish(None)
-        self.assertEqual(self.exists("%s.filesafe" % target), False)
+        self.assertEqual(self.exists(backup), False)
 
     def test_finish_with_missing_original(self):
         dm = self.dm
@@ -158,11 +279,12 @@ class FileSafeDataManagerTests(unittest.TestCase):
         dm = self.dm
         target = os.path.join(self.tempdir, "greeting")
         self.open(target, "w").close()
-        targetsafe = target + ".filesafe"
+        targetsafe = target + ".filesafe-1234"
         f = self.open(targetsafe, "w")
         f.write("...---...")
         f.close()
-        dm.vault = {target: dict(has_original=True, moved=True)}
+        dm.vault = {target: dict(has_original=True, moved=True,
+                                 backup=targetsafe)}
         dm.tpc_abort(None)
         self.assertEqual(self.exists(target), True)
         self.assertEqual(self.exists(targetsafe), False)
@@ -198,6 +320,48 @@ class FileSafeDataManagerTests(unittest.TestCase):
         self.failUnless("testOpenFileInVault" in f.read())
         f.close()
 
+    def test_map_file_in_vault(self):
+        dm = self.dm
+        f = dm.create_file("dummy", "wb")
+        f.write(b"Hello!")
+        f.close()
+        m = dm.map_file("dummy")
+        self.assertEqual(bytes(m[:5]), b"Hello")
+        self.assertEqual(len(m), 6)
+
+    def test_map_empty_file(self):
+        dm = self.dm
+        dm.create_file("dummy", "wb").close()
+        self.assertEqual(len(dm.map_file("dummy")), 0)
+
+    def test_map_deleted_file(self):
+        dm = self.dm
+        dm.create_file("dummy", "wb").close()
+        dm.delete_file("dummy")
+        self.assertRaises(IOError, dm.map_file, "dummy")
+
+    def test_map_file_released_on_commit(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        f = dm.create_file(target, "wb")
+        f.write(b"Hello!")
+        f.close()
+        m = dm.map_file(target)
+        self.assertEqual(m[:], b"Hello!")
+        dm.commit(None)
+        self.assertEqual(m.closed, True)
+        dm.tpc_finish(None)
+        self.assertEqual(self.open(target).read(), "Hello!")
+
+    def test_map_file_outside_vault(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        with open(target, "wb") as f:
+            f.write(b"Hello!")
+        m = dm.map_file(target)
+        self.assertEqual(m[:], b"Hello!")
+        m.close()
+
     def test_delete_new_file_before_commit(self):
         dm = self.dm
         target = os.path.join(self.tempdir, "greeting")
@@ -515,27 +679,2426 @@ class FileSafeDataManagerTests(unittest.TestCase):
         self.failUnless(dm.file_exists(source))
         self.assertEqual(self.open(source).read(), "...---...")
 
+    def test_create_files(self):
+        dm = self.dm
+        names = ["f%d" % i for i in range(10)]
+        targets = [os.path.join(self.tempdir, name) for name in names]
+        dm.create_file(targets[0], "w")
+        (files, errors) = dm.create_files(targets, "w")
+        self.assertEqual(list(errors), [targets[0]])
+        self.failUnless(isinstance(errors[targets[0]], ValueError))
+        self.assertEqual(sorted(files), targets[1:])
+        for target in targets[1:]:
+            files[target].write(target)
+            files[target].close()
+            self.failUnless(dm.file_exists(target))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        for target in targets[1:]:
+            self.assertEqual(self.open(target).read(), target)
 
-class DummyDataManagerTests(FileSafeDataManagerTests):
-    DM = DummyDataManager
+    def test_delete_files(self):
+        dm = self.dm
+        targets = [os.path.join(self.tempdir, "f%d" % i) for i in range(10)]
+        for target in targets[:-1]:
+            self.open(target, "w").close()
+        errors = dm.delete_files(targets)
+        self.assertEqual(list(errors), [targets[-1]])
+        self.assertEqual(errors[targets[-1]].errno, errno.ENOENT)
+        for target in targets:
+            self.failIf(dm.file_exists(target))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        for target in targets:
+            self.assertEqual(self.exists(target), False)
 
-    def exists(self, path):
-        return path in self.dm.data
+    def test_rename_files(self):
+        dm = self.dm
+        sources = [os.path.join(self.tempdir, "f%d" % i) for i in range(10)]
+        for source in sources[:-1]:
+            with self.open(source, "w") as fd:
+                fd.write(source)
+        pairs = [(source, source + "-new") for source in sources]
+        errors = dm.rename_files(pairs)
+        self.assertEqual(list(errors), [sources[-1]])
+        self.assertEqual(errors[sources[-1]].errno, errno.ENOENT)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        for source in sources[:-1]:
+            self.assertEqual(self.exists(source), False)
+            self.assertEqual(self.open(source + "-new").read(), source)
+
+
+def _has_renameat2():
+    from repoze.filesafe.backends import _load_renameat2
+    return bool(_load_renameat2())
 
-    def open(self, path, mode='r'):
-        cls = MockBytesIO if 'b' in mode else MockStringIO
-        if mode is None or 'r' in mode:
-            return cls(self.dm.data[path].mockdata)
-        elif 'w' in mode:
-            f = self.dm.data[path] = cls()
-            return f
+
+@unittest.skipUnless(_has_renameat2(), "renameat2 is not available")
+class Renameat2DataManagerTests(FileSafeDataManagerTests):
 
     def setUp(self):
-        self.tempdir = "/dummy"
-        self.dm = self.DM(self.tempdir)
+        FileSafeDataManagerTests.setUp(self)
+        self.dm.use_renameat2 = True
+
+    def test_commit_with_original(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        with self.open(target, "w") as f:
+            f.write("...---...")
+        newfile = dm.create_file(target, "w")
+        newfile.write("Hello, World!")
+        newfile.close()
+        dm.commit(None)
+        self.assertEqual(dm.vault[target]["exchanged"], True)
+        self.assertEqual(self.open(target).read(), "Hello, World!")
+        self.assertEqual(self.exists("%s.filesafe" % target), False)
+        self.assertEqual(self.open(newfile.name).read(), "...---...")
+        dm.tpc_finish(None)
+        self.assertEqual(self.exists(newfile.name), False)
+
+    def test_abort_exchanged_file(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        with self.open(target, "w") as f:
+            f.write("...---...")
+        newfile = dm.create_file(target, "w")
+        newfile.write("Hello, World!")
+        newfile.close()
+        dm.commit(None)
+        dm.tpc_abort(None)
+        self.assertEqual(self.open(target).read(), "...---...")
+
+    def test_commit_detects_concurrent_create(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        dm.create_file(target, "w").close()
+        # Create the file after the conflict check done before commit
+        dm._check_conflicts = lambda: None
+        with self.open(target, "w") as f:
+            f.write("Someone else")
+        self.assertRaises(FileConflictError, dm.commit, None)
+        dm.tpc_abort(None)
+        self.assertEqual(self.open(target).read(), "Someone else")
+
+    def test_replace_dir(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "tree")
+        os.mkdir(target)
+        staging = dm.replace_dir(target)
+        self.open(os.path.join(staging, "new"), "w").close()
+        dm.commit(None)
+        self.assertEqual(os.listdir(target), ["new"])
+        self.assertEqual(os.path.exists("%s.filesafe" % target), False)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(os.listdir(target), [])
+
+    def test_fallback(self):
+        from repoze.filesafe import backends
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        dm.create_file(target, "w").close()
+        function = backends._renameat2_function
+        backends._renameat2_function = False
+        try:
+            dm.commit(None)
+        finally:
+            backends._renameat2_function = function
+        self.assertEqual(dm.vault[target].get("exchanged"), None)
+        self.assertEqual(self.exists(target), True)
+
+
+class DirectoryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.filesafe.backends import DirectoryCache
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = DirectoryCache(2)
+        self.dirs = []
+        for name in ["a", "b", "c"]:
+            path = os.path.join(self.tempdir, name)
+            os.mkdir(path)
+            self.dirs.append(path)
 
     def tearDown(self):
-        pass
+        self.cache.close()
+        shutil.rmtree(self.tempdir)
 
-    def test_delete_non_existing_file(self):
-        pass
+    def test_operations(self):
+        cache = self.cache
+        (a, b, c) = [os.path.join(path, "file") for path in self.dirs]
+        open(a, "w").close()
+        self.assertEqual(cache.exists(a), True)
+        cache.link(a, b)
+        cache.rename(b, c)
+        self.assertEqual(cache.exists(b), False)
+        self.assertEqual(cache.stat(a).st_ino, cache.stat(c).st_ino)
+        cache.unlink(a)
+        self.assertEqual(os.path.exists(a), False)
+        self.assertEqual(list(cache.fds), [self.dirs[2], self.dirs[0]])
+
+    def test_bounded(self):
+        cache = self.cache
+        fds = [cache.resolve(os.path.join(path, "x"))[0]
+               for path in self.dirs]
+        self.assertEqual(list(cache.fds), self.dirs[1:])
+        self.assertRaises(OSError, os.fstat, fds[0])
+        cache.close()
+        self.assertEqual(len(cache.fds), 0)
+        self.assertRaises(OSError, os.fstat, fds[2])
+
+    def test_relative_path(self):
+        self.assertEqual(self.cache.resolve("file"), (None, "file"))
+
+    def test_symlink_swap_after_open(self):
+        cache = self.cache
+        (a, b) = self.dirs[:2]
+        open(os.path.join(a, "file"), "w").close()
+        cache.resolve(os.path.join(a, "file"))
+        os.rename(a, a + "-moved")
+        os.symlink(b, a)
+        # Operations still apply to the directory that was opened
+        cache.unlink(os.path.join(a, "file"))
+        self.assertEqual(os.listdir(a + "-moved"), [])
+
+    def test_rename_forgets_moved_directories(self):
+        cache = self.cache
+        a = self.dirs[0]
+        os.mkdir(os.path.join(a, "sub"))
+        cache.resolve(os.path.join(a, "sub", "file"))
+        cache.resolve(os.path.join(a, "file"))
+        cache.rename(a, a + "-moved")
+        self.assertEqual(list(cache.fds), [self.tempdir])
+        os.mkdir(a)
+        open(os.path.join(a, "file"), "w").close()
+        self.assertEqual(cache.exists(os.path.join(a, "file")), True)
+
+    def test_replace_dir_with_new_file(self):
+        dm = FileSafeDataManager(self.tempdir)
+        target = self.dirs[0]
+        open(os.path.join(target, "old"), "w").close()
+        staging = dm.replace_dir(target)
+        open(os.path.join(staging, "x"), "w").close()
+        with dm.create_file(os.path.join(target, "y"), "w") as f:
+            f.write("Hello")
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        wait_for_removals()
+        self.assertEqual(sorted(os.listdir(target)), ["x", "y"])
+
+    def test_verify(self):
+        cache = self.cache
+        a = self.dirs[0]
+        cache.resolve(os.path.join(a, "file"))
+        self.assertEqual(cache.verify([a, self.dirs[1]]), [])
+        os.rename(a, a + "-moved")
+        os.mkdir(a)
+        self.assertEqual(cache.verify([a, self.dirs[1]]), [a])
+
+    def test_request_phase_does_not_cache(self):
+        dm = FileSafeDataManager(self.tempdir)
+        self.failIf(dm.file_exists(os.path.join(self.dirs[0], "x")))
+        self.assertEqual(len(dm.backend.dirs.fds), 0)
+        dm.tpc_abort(None)
+
+    def test_directory_replaced_by_other_transaction(self):
+        target = self.dirs[0]
+        path = os.path.join(target, "x")
+        one = FileSafeDataManager(self.tempdir)
+        self.failIf(one.file_exists(path))
+        other = FileSafeDataManager(self.tempdir)
+        staging = other.replace_dir(target)
+        open(os.path.join(staging, "new"), "w").close()
+        other.commit(None)
+        other.tpc_finish(None)
+        with one.create_file(path, "w") as f:
+            f.write("Hello")
+        one.commit(None)
+        one.tpc_finish(None)
+        wait_for_removals()
+        self.assertEqual(sorted(os.listdir(target)), ["new", "x"])
+        self.assertEqual(open(path).read(), "Hello")
+
+    def test_commit_detects_replaced_directory(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = FileSafeDataManager(self.tempdir)
+        target = self.dirs[0]
+        dm.create_file(os.path.join(target, "x"), "w").close()
+        # The directory is replaced right after the commit opened it
+        open_dirs = dm.backend.open_dirs
+
+        def replace(directories):
+            dm.backend.dirs.verify([target])
+            os.rename(target, target + "-moved")
+            os.mkdir(target)
+            return open_dirs(directories)
+        dm.backend.open_dirs = replace
+        self.assertRaises(FileConflictError, dm.commit, None)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(os.listdir(target), [])
+
+    def test_manager_closes_cache(self):
+        dm = FileSafeDataManager(self.tempdir)
+        target = os.path.join(self.dirs[0], "file")
+        dm.create_file(target, "w").close()
+        dm.commit(None)
+        self.failUnless(dm.backend.dirs.fds)
+        dm.tpc_finish(None)
+        self.assertEqual(len(dm.backend.dirs.fds), 0)
+        self.assertEqual(os.path.exists(target), True)
+
+
+class StagingDirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "greeting")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_staging_directory_per_manager(self):
+        import threading
+        dm = self.dm
+        f = dm.create_file(self.target, "w")
+        stagedir = os.path.dirname(f.name)
+        self.assertEqual(stagedir, dm.backend.stagedir)
+        self.assertEqual(os.path.dirname(stagedir), self.tempdir)
+        self.failUnless(os.path.basename(stagedir).startswith(
+            "filesafe-%d-%d-%x-" % (os.getpid(), threading.get_ident(),
+                                    id(dm.backend))))
+        other = FileSafeDataManager(self.tempdir)
+        g = other.create_file(self.target, "w")
+        self.assertNotEqual(os.path.dirname(g.name), stagedir)
+
+    def test_finish_removes_staging_directory(self):
+        dm = self.dm
+        dm.create_file(self.target, "w").close()
+        stagedir = dm.backend.stagedir
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(os.path.exists(stagedir), False)
+        self.assertEqual(dm.backend.stagedir, None)
+
+    def test_abort_removes_staging_directory(self):
+        dm = self.dm
+        for name in ["one", "two", "three"]:
+            dm.create_file(os.path.join(self.tempdir, name), "w").close()
+        stagedir = dm.backend.stagedir
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertEqual(os.path.exists(stagedir), False)
+
+
+class ReaperTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, "root")
+        os.mkdir(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def dead_pid(self):
+        import subprocess
+        import sys
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        return process.pid
+
+    def make_staging(self, pid):
+        path = tempfile.mkdtemp(dir=self.tempdir,
+                prefix="filesafe-%d-1-abc-" % pid)
+        with open(os.path.join(path, "tmpfile"), "w") as f:
+            f.write("x" * 10)
+        return path
+
+    def make_file(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, "w") as f:
+            f.write(data)
+        return path
+
+    def _callFUT(self, **kw):
+        from repoze.filesafe.reaper import reap
+        kw.setdefault("tempdir", self.tempdir)
+        kw.setdefault("roots", [self.root])
+        return reap(**kw)
+
+    def test_staging_of_dead_process(self):
+        dead = self.make_staging(self.dead_pid())
+        alive = self.make_staging(os.getpid())
+        report = self._callFUT()
+        self.assertEqual(report.removed, [dead])
+        self.failUnless(report.bytes >= 10)
+        self.assertEqual(os.path.exists(dead), False)
+        self.assertEqual(os.path.exists(alive), True)
+
+    def test_old_staging_of_live_process(self):
+        self.make_staging(os.getpid())
+        report = self._callFUT(max_age=-1)
+        self.assertEqual(report.removed, [])
+
+    def test_staging_of_reused_pid(self):
+        from repoze.filesafe import reaper
+        staging = self.make_staging(os.getpid())
+        original = reaper._process_started
+        reaper._process_started = lambda pid: time.time() + 10
+        try:
+            self.assertEqual(self._callFUT().removed, [])
+            self.assertEqual(self._callFUT(max_age=-1).removed, [staging])
+        finally:
+            reaper._process_started = original
+
+    def test_backup_with_target(self):
+        target = self.make_file("greeting", "new")
+        backup = self.make_file("greeting.filesafe", "old")
+        self.assertEqual(self._callFUT().removed, [])
+        report = self._callFUT(max_age=-1)
+        self.assertEqual(report.removed, [backup])
+        self.assertEqual(report.bytes, 3)
+        self.assertEqual(os.path.exists(backup), False)
+        self.assertEqual(open(target).read(), "new")
+
+    def test_backup_without_target(self):
+        backup = self.make_file("greeting.filesafe", "old")
+        report = self._callFUT(max_age=-1, restore=True)
+        self.assertEqual(report.restored, [backup])
+        self.assertEqual(
+            open(os.path.join(self.root, "greeting")).read(), "old")
+
+    def test_transaction_backup_without_target(self):
+        backup = self.make_file("greeting.filesafe-0badcafe", "old")
+        report = self._callFUT(max_age=-1, restore=True)
+        self.assertEqual(report.restored, [backup])
+        self.assertEqual(
+            open(os.path.join(self.root, "greeting")).read(), "old")
+
+    def test_unrelated_names_are_no_backups(self):
+        for name in ["notes.filesafe-draft", "greeting.filesafe-abc",
+                     "greeting.filesafe-0123456789", "greeting.filesafes",
+                     "greeting.filesafe-0BADCAFE"]:
+            self.make_file(name, "mine")
+        report = self._callFUT(max_age=-1, restore=True)
+        self.assertEqual(report.removed, [])
+        self.assertEqual(report.restored, [])
+        self.assertEqual(len(os.listdir(self.root)), 5)
+
+    def test_vault_of_dead_process(self):
+        from repoze.filesafe.vault import SpillVault
+        vaults = []
+        for pid in [self.dead_pid(), os.getpid()]:
+            path = os.path.join(self.tempdir, "filesafe-vault-%d-x" % pid)
+            with open(path, "w") as f:
+                f.write("x")
+            vaults.append(path)
+        vault = SpillVault(self.tempdir)
+        vault["/a"] = {}
+        try:
+            self.failUnless(os.path.basename(vault.path).startswith(
+                    "filesafe-vault-%d-" % os.getpid()))
+            report = self._callFUT()
+            self.assertEqual(report.removed, vaults[:1])
+            self.assertEqual(os.path.exists(vault.path), True)
+        finally:
+            vault.clear()
+
+    def test_backup_without_target_no_restore(self):
+        backup = self.make_file("greeting.filesafe", "old")
+        report = self._callFUT(max_age=-1)
+        self.assertEqual(report.removed, [backup])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_dry_run(self):
+        backup = self.make_file("greeting.filesafe", "old")
+        dead = self.make_staging(self.dead_pid())
+        report = self._callFUT(max_age=-1, restore=True, dry_run=True)
+        self.assertEqual(report.removed, [dead])
+        self.assertEqual(report.restored, [backup])
+        self.assertEqual(os.path.exists(dead), True)
+        self.assertEqual(os.path.exists(backup), True)
+
+    def test_limit(self):
+        pid = self.dead_pid()
+        for i in range(3):
+            self.make_staging(pid)
+        self.assertEqual(len(self._callFUT(limit=2).removed), 2)
+        self.assertEqual(len(self._callFUT(limit=2).removed), 1)
+
+    def test_main(self):
+        from repoze.filesafe.reaper import main
+        self.make_file("greeting.filesafe", "old")
+        self.assertEqual(main(["--tempdir", self.tempdir, "--max-age", "-1",
+                               "--dry-run", self.root]), 0)
+
+
+class DirectoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "tree")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def make_tree(self, path, data):
+        os.mkdir(path)
+        with open(os.path.join(path, "data"), "w") as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(os.path.join(path, "data")) as f:
+            return f.read()
+
+    def test_create_dir(self):
+        dm = self.dm
+        staging = dm.create_dir(self.target)
+        self.make_tree(os.path.join(staging, "sub"), "new")
+        self.failUnless(dm.file_exists(self.target))
+        self.assertEqual(dm.file_path(self.target), staging)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(self.read(os.path.join(self.target, "sub")), "new")
+        self.assertEqual(os.path.exists(staging), False)
+
+    def test_create_existing_dir(self):
+        os.mkdir(self.target)
+        try:
+            self.dm.create_dir(self.target)
+        except OSError as e:
+            self.assertEqual(e.errno, errno.EEXIST)
+        else:  # pragma: no cover
+            self.fail('No OSError exception raised')
+
+    def test_dir_permissions(self):
+        umask = os.umask(0o022)
+        try:
+            staging = self.dm.create_dir(self.target)
+        finally:
+            os.umask(umask)
+        self.dm.commit(None)
+        self.dm.tpc_finish(None)
+        self.assertEqual(os.stat(self.target).st_mode & 0o777, 0o755)
+        self.assertEqual(os.path.exists(staging), False)
+
+    def test_replace_file_with_dir(self):
+        with open(self.target, "w") as f:
+            f.write("file")
+        try:
+            self.dm.replace_dir(self.target)
+        except OSError as e:
+            self.assertEqual(e.errno, errno.ENOTDIR)
+        else:  # pragma: no cover
+            self.fail('No OSError exception raised')
+        self.assertEqual(self.dm.vault, {})
+
+    def test_discard_file_backup(self):
+        from repoze.filesafe.backends import _remove_later
+        backup = self.target + ".filesafe-0badcafe"
+        open(backup, "w").close()
+        _remove_later([backup])
+        wait_for_removals()
+        self.assertEqual(os.path.exists(backup), False)
+
+    def test_abort_create_dir(self):
+        dm = self.dm
+        staging = dm.create_dir(self.target)
+        self.make_tree(os.path.join(staging, "sub"), "new")
+        dm.commit(None)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(os.path.exists(self.target), False)
+        self.assertEqual(os.path.exists(staging), False)
+
+    def test_replace_dir(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        staging = dm.replace_dir(self.target)
+        with open(os.path.join(staging, "data"), "w") as f:
+            f.write("new")
+        dm.commit(None)
+        self.assertEqual(self.read(self.target), "new")
+        backup = dm.vault[self.target]["backup"]
+        self.assertEqual(self.read(backup), "old")
+        dm.tpc_finish(None)
+        wait_for_removals()
+        self.assertEqual(self.read(self.target), "new")
+        self.assertEqual(os.path.exists(backup), False)
+
+    def test_replace_dir_twice(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        # A stale backup of an earlier commit does not get in the way.
+        self.make_tree(self.target + ".filesafe", "stale")
+        for data in ("one", "two"):
+            staging = dm.replace_dir(self.target)
+            with open(os.path.join(staging, "data"), "w") as f:
+                f.write(data)
+            dm.commit(None)
+            dm.tpc_finish(None)
+        self.assertEqual(self.read(self.target), "two")
+
+    def test_abort_replace_dir(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        staging = dm.replace_dir(self.target)
+        with open(os.path.join(staging, "data"), "w") as f:
+            f.write("new")
+        dm.commit(None)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(self.read(self.target), "old")
+        self.assertEqual(os.path.exists(self.target + ".filesafe"), False)
+        self.assertEqual(os.path.exists(staging), False)
+
+    def test_delete_tree(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        dm.delete_tree(self.target)
+        self.failIf(dm.file_exists(self.target))
+        dm.commit(None)
+        self.assertEqual(os.path.exists(self.target), False)
+        dm.tpc_finish(None)
+        wait_for_removals()
+        self.assertEqual(os.path.exists(self.target + ".filesafe"), False)
+
+    def test_abort_delete_tree(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        dm.delete_tree(self.target)
+        dm.commit(None)
+        dm.tpc_abort(None)
+        self.assertEqual(self.read(self.target), "old")
+
+    def test_abort_delete_tree_before_commit(self):
+        dm = self.dm
+        self.make_tree(self.target, "old")
+        dm.delete_tree(self.target)
+        dm.tpc_abort(None)
+        self.assertEqual(self.read(self.target), "old")
+
+    def test_delete_staged_tree(self):
+        dm = self.dm
+        staging = dm.create_dir(self.target)
+        dm.delete_tree(self.target)
+        self.assertEqual(os.path.exists(staging), False)
+        self.failIf(dm.file_exists(self.target))
+
+    def test_delete_missing_tree(self):
+        self.assertRaises(OSError, self.dm.delete_tree, self.target)
+
+    def test_abort_delete_file_before_commit(self):
+        dm = self.dm
+        with open(self.target, "w") as f:
+            f.write("old")
+        dm.delete_file(self.target)
+        dm.tpc_abort(None)
+        self.assertEqual(open(self.target).read(), "old")
+
+
+class PublishDirTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.link = os.path.join(self.tempdir, "site")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def publish(self, data, keep=1):
+        staging = self.dm.publish_dir(self.link, keep)
+        with open(os.path.join(staging, "index.html"), "w") as f:
+            f.write(data)
+        return staging
+
+    def read(self):
+        with open(os.path.join(self.link, "index.html")) as f:
+            return f.read()
+
+    def generations(self):
+        wait_for_removals()
+        return sorted(entry for entry in os.listdir(self.tempdir)
+                if entry.startswith("site.generation-"))
+
+    def test_first_publish(self):
+        dm = self.dm
+        staging = self.publish("one")
+        self.assertEqual(os.path.lexists(self.link), False)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(os.readlink(self.link), os.path.basename(staging))
+        self.assertEqual(self.read(), "one")
+
+    def test_publish_keeps_previous_generations(self):
+        dm = self.dm
+        first = os.path.basename(self.publish("one"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        second = os.path.basename(self.publish("two"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(self.read(), "two")
+        self.assertEqual(self.generations(), [first, second])
+        third = os.path.basename(self.publish("three"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(self.read(), "three")
+        self.assertEqual(self.generations(), [second, third])
+
+    def test_publish_keeps_unpublished_generations(self):
+        first = self.dm
+        staging = self.publish("one")
+        second = self.dm = FileSafeDataManager(self.tempdir)
+        for data in ["two", "three"]:
+            self.publish(data)
+            second.commit(None)
+            second.tpc_finish(None)
+        self.assertEqual(len(self.generations()), 3)
+        first.commit(None)
+        first.tpc_finish(None)
+        self.assertEqual(os.readlink(self.link), os.path.basename(staging))
+        self.assertEqual(self.read(), "one")
+        self.assertEqual(len(self.generations()), 2)
+        with open(self.link + ".generations") as f:
+            self.assertEqual(f.read().split()[-1],
+                             os.path.basename(staging))
+
+    def test_generation_permissions(self):
+        umask = os.umask(0o022)
+        try:
+            staging = self.dm.publish_dir(self.link)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(staging).st_mode & 0o777, 0o755)
+        self.dm.tpc_abort(None)
+
+    def test_publish_without_retention(self):
+        dm = self.dm
+        self.publish("one")
+        dm.commit(None)
+        dm.tpc_finish(None)
+        second = os.path.basename(self.publish("two", keep=0))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(self.generations(), [second])
+
+    def test_abort_publish(self):
+        dm = self.dm
+        first = self.publish("one")
+        dm.commit(None)
+        dm.tpc_finish(None)
+        second = self.publish("two")
+        dm.commit(None)
+        self.assertEqual(self.read(), "two")
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(self.read(), "one")
+        self.assertEqual(os.readlink(self.link), os.path.basename(first))
+        self.assertEqual(os.path.exists(second), False)
+
+    def test_abort_publish_keeps_history(self):
+        dm = self.dm
+        first = os.path.basename(self.publish("one"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.publish("two")
+        dm.commit(None)
+        dm.tpc_abort(None)
+        with open(self.link + ".generations") as f:
+            self.assertEqual(f.read().split(), [first])
+
+    def test_publish_ignores_fixed_temporary_names(self):
+        for name in [self.link + ".filesafe",
+                     self.link + ".generations.filesafe"]:
+            with open(name, "w") as f:
+                f.write("someone else")
+        self.publish("one")
+        self.dm.commit(None)
+        self.dm.tpc_finish(None)
+        self.publish("two", keep=0)
+        self.dm.commit(None)
+        self.dm.tpc_finish(None)
+        self.assertEqual(self.read(), "two")
+        for name in [self.link + ".filesafe",
+                     self.link + ".generations.filesafe"]:
+            with open(name) as f:
+                self.assertEqual(f.read(), "someone else")
+
+    def test_abort_first_publish(self):
+        dm = self.dm
+        staging = self.publish("one")
+        dm.commit(None)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(os.path.lexists(self.link), False)
+        self.assertEqual(os.path.exists(staging), False)
+
+    def test_publish_over_directory(self):
+        os.mkdir(self.link)
+        self.assertRaises(ValueError, self.dm.publish_dir, self.link)
+
+
+class FileConflictTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "greeting")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, data):
+        with open(self.target, "w") as f:
+            f.write(data)
+
+    def test_conflict_error_is_transient(self):
+        from transaction.interfaces import TransientError
+        from repoze.filesafe.manager import FileConflictError
+        self.failUnless(issubclass(FileConflictError, TransientError))
+
+    def test_directory_contents_are_no_conflict(self):
+        dm = self.dm
+        self.failUnless(dm.file_exists(self.tempdir))
+        self.write("Someone else")
+        dm.create_file(os.path.join(self.tempdir, "mine"), "w").close()
+        dm.commit(None)
+        dm.tpc_finish(None)
+
+    def test_publish_in_observed_directory(self):
+        dm = self.dm
+        self.failUnless(dm.file_exists(self.tempdir))
+        dm.publish_dir(os.path.join(self.tempdir, "site"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+
+    def test_replaced_directory_is_conflict(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        path = os.path.join(self.tempdir, "dir")
+        os.mkdir(path)
+        self.failUnless(dm.file_exists(path))
+        os.rename(path, path + "-old")
+        os.mkdir(path)
+        self.assertRaises(FileConflictError, dm.commit, None)
+
+    def test_create_file_detects_concurrent_create(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        dm.create_file(self.target, "w").close()
+        self.write("Someone else")
+        self.assertRaises(FileConflictError, dm.commit, None)
+        self.assertEqual(dm.in_commit, False)
+        self.assertEqual(open(self.target).read(), "Someone else")
+
+    def test_open_file_detects_concurrent_change(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        self.write("a")
+        dm.open_file(self.target).close()
+        self.write("bb")
+        self.assertRaises(FileConflictError, dm.commit, None)
+
+    def test_open_file_for_writing(self):
+        dm = self.dm
+        self.write("a")
+        dm.open_file(self.target).close()
+        with dm.open_file(self.target, "a") as f:
+            f.write("b")
+        self.assertEqual(dm.observed, {})
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        self.assertEqual(open(self.target).read(), "ab")
+
+    def test_file_exists_detects_concurrent_delete(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        self.write("a")
+        self.failUnless(dm.file_exists(self.target))
+        os.unlink(self.target)
+        self.failIf(dm.file_exists(self.target))
+        self.assertRaises(FileConflictError, dm.commit, None)
+
+    def test_unchanged_files_commit(self):
+        dm = self.dm
+        self.write("a")
+        dm.file_exists(self.target)
+        f = dm.create_file(self.target, "w")
+        f.write("b")
+        f.close()
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(open(self.target).read(), "b")
+        self.assertEqual(dm.observed, {})
+
+
+class DummyDataManagerTests(FileSafeDataManagerTests):
+    DM = DummyDataManager
+
+    def exists(self, path):
+        return path in self.dm.data
+
+    def open(self, path, mode='r'):
+        cls = MockBytesIO if 'b' in mode else MockStringIO
+        if mode is None or 'r' in mode:
+            return cls(self.dm.data[path].mockdata)
+        elif 'w' in mode:
+            f = self.dm.data[path] = cls()
+            return f
+
+    def setUp(self):
+        self.tempdir = "/dummy"
+        self.dm = self.DM(self.tempdir)
+
+    def tearDown(self):
+        pass
+
+    def test_map_file_released_on_commit(self):
+        pass
+
+    def test_map_file_outside_vault(self):
+        pass
+
+
+class ChrootDataManagerTests(FileSafeDataManagerTests):
+
+    def real(self, path):
+        return self.dm.backend._real(path)
+
+    def exists(self, path):
+        return os.path.exists(self.real(path))
+
+    def open(self, path, mode=None):
+        return FileSafeDataManagerTests.open(self, self.real(path), mode)
+
+    def setUp(self):
+        from repoze.filesafe.backends import ChrootBackend
+        self.root = tempfile.mkdtemp()
+        self.tempdir = "/work"
+        os.mkdir(os.path.join(self.root, "work"))
+        self.dm = FileSafeDataManager(
+                backend=ChrootBackend(self.root, self.tempdir))
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.root)
+
+    def test_paths_are_confined(self):
+        dm = self.dm
+        self.assertEqual(self.real("/../../etc/passwd"),
+                         os.path.join(self.root, "etc", "passwd"))
+        f = dm.create_file("/work/../../greeting", "w")
+        f.write("Hello")
+        f.close()
+        self.failUnless(f.name.startswith(os.path.join(self.root, "work")))
+        staged = dm.vault["/work/../../greeting"]["tempfile"]
+        self.failUnless(staged.startswith("/work/filesafe-"))
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(
+                open(os.path.join(self.root, "greeting")).read(), "Hello")
+
+    def test_open_file_outside_vault(self):
+        pass
+
+    def test_map_file_outside_vault(self):
+        pass
+
+
+class MemoryReaderTests(unittest.TestCase):
+
+    def test_read(self):
+        from repoze.filesafe.backends import MemoryReader
+        f = MemoryReader(b"Hello, World!")
+        self.assertEqual(f.read(5), b"Hello")
+        self.assertEqual(f.tell(), 5)
+        self.assertEqual(f.read(), b", World!")
+        self.assertEqual(f.read(), b"")
+        f.seek(-6, os.SEEK_END)
+        self.assertEqual(f.read(5), b"World")
+
+    def test_readinto(self):
+        from repoze.filesafe.backends import MemoryReader
+        f = MemoryReader(b"Hello, World!")
+        buffer = bytearray(5)
+        self.assertEqual(f.readinto(buffer), 5)
+        self.assertEqual(buffer, b"Hello")
+        f.seek(10)
+        self.assertEqual(f.readinto(buffer), 3)
+        self.assertEqual(buffer[:3], b"ld!")
+
+    def test_getbuffer_does_not_copy(self):
+        from repoze.filesafe.backends import MemoryReader
+        data = b"Hello, World!"
+        f = MemoryReader(data)
+        f.seek(7)
+        view = f.getbuffer()
+        self.failUnless(view.obj is data)
+        self.assertEqual(view, b"World!")
+
+    def test_closed(self):
+        from repoze.filesafe.backends import MemoryReader
+        f = MemoryReader(b"Hello")
+        f.close()
+        self.assertRaises(ValueError, f.read)
+
+    def test_dummy_data_manager_shares_data(self):
+        dm = DummyDataManager()
+        with dm.create_file("greeting", "wb") as f:
+            f.write(b"Hello, World!")
+        f = dm.open_file("greeting", "rb")
+        self.failUnless(f.getbuffer().obj is dm.data[dm.vault["greeting"]
+                                                    ["tempfile"]].mockdata)
+        self.failUnless(dm.map_file("greeting").obj is f.getbuffer().obj)
+
+
+class ParityTests(unittest.TestCase):
+    """Check that the in-memory backend behaves like the filesystem."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def compare(self, scenario):
+        results = []
+        for dm in [FileSafeDataManager(self.tempdir), DummyDataManager()]:
+            def path(name):
+                return os.path.join(self.tempdir, name)
+            results.append(scenario(dm, path))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def write(self, dm, path, data):
+        with dm.create_file(path, "wb") as f:
+            f.write(data)
+
+    def read(self, dm, path):
+        if not dm.file_exists(path):
+            return None
+        with dm.open_file(path, "rb") as f:
+            return f.read()
+
+    def test_commit_and_abort(self):
+        def scenario(dm, path):
+            self.write(dm, path("a"), b"one")
+            dm.commit(None)
+            dm.tpc_finish(None)
+            self.write(dm, path("a"), b"two")
+            self.write(dm, path("b"), b"new")
+            before = (self.read(dm, path("a")), self.read(dm, path("b")))
+            dm.commit(None)
+            dm.tpc_abort(None)
+            return before + (self.read(dm, path("a")),
+                             self.read(dm, path("b")))
+        self.assertEqual(self.compare(scenario),
+                         (b"two", b"new", b"one", None))
+
+    def test_delete_and_rename(self):
+        def scenario(dm, path):
+            for name in ["a", "b", "c"]:
+                self.write(dm, path(name), name.encode("ascii"))
+            dm.commit(None)
+            dm.tpc_finish(None)
+            dm.delete_file(path("a"))
+            dm.rename_file(path("b"), path("d"))
+            errors = dm.delete_files([path("c"), path("x")])
+            dm.commit(None)
+            dm.tpc_finish(None)
+            return (dict((os.path.basename(p), e.errno)
+                         for (p, e) in errors.items()),
+                    [self.read(dm, path(name)) for name in "abcd"])
+        self.assertEqual(self.compare(scenario),
+                         ({"x": errno.ENOENT}, [None, None, None, b"b"]))
+
+    def test_conflicting_operations(self):
+        def scenario(dm, path):
+            self.write(dm, path("a"), b"a")
+            results = []
+            for operation in [lambda: dm.create_file(path("a"), "wb"),
+                              lambda: dm.delete_file(path("x")),
+                              lambda: dm.rename_file(path("x"), path("y")),
+                              lambda: dm.open_file(path("x"), "rb")]:
+                try:
+                    operation()
+                except (ValueError, IOError, OSError) as e:
+                    results.append(type(e))
+            dm.tpc_abort(None)
+            return results
+        self.assertEqual(len(self.compare(scenario)), 4)
+
+
+class DummyDataManagerContextTests(unittest.TestCase):
+
+    def test_dummy_data_manager(self):
+        import repoze.filesafe
+        from repoze.filesafe.testing import dummy_data_manager
+        outer = DummyDataManager()
+        token = repoze.filesafe._pinned.set(outer)
+        try:
+            with dummy_data_manager() as dm:
+                self.failUnless(repoze.filesafe.get_manager() is dm)
+                repoze.filesafe.create_file("greeting", "w").close()
+            self.failUnless(repoze.filesafe.get_manager() is outer)
+        finally:
+            repoze.filesafe._pinned.reset(token)
+        self.assertEqual(list(dm.vault), ["greeting"])
+
+    def test_pytest_plugin(self):
+        try:
+            import pytest
+        except ImportError:  # pragma: no cover
+            self.skipTest("pytest is not installed")
+        import repoze.filesafe
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "test_fixture.py")
+            with open(path, "w") as f:
+                f.write(_PLUGIN_TEST)
+            # Load the plugin from this tree, not from an installed copy.
+            result = pytest.main([path, "-q", "--rootdir", tempdir,
+                    "-p", "no:cacheprovider", "-p", "no:repoze.filesafe",
+                    "-p", "repoze.filesafe.pytest_plugin"])
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(result, pytest.ExitCode.OK)
+        self.assertEqual(repoze.filesafe._pinned.get(None), None)
+
+
+_PLUGIN_TEST = """\
+import repoze.filesafe
+from repoze.filesafe.testing import DummyDataManager
+
+
+def test_fixture(filesafe_manager):
+    assert isinstance(filesafe_manager, DummyDataManager)
+    assert repoze.filesafe.get_manager() is filesafe_manager
+    repoze.filesafe.create_file("greeting", "w").close()
+    assert "greeting" in filesafe_manager.vault
+"""
+
+
+class SpillVaultTests(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.filesafe.vault import SpillVault
+        self.tempdir = tempfile.mkdtemp()
+        self.vault = SpillVault(self.tempdir, cache_size=2, batch_size=2)
+
+    def tearDown(self):
+        self.vault.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_empty(self):
+        vault = self.vault
+        self.assertEqual(len(vault), 0)
+        self.assertEqual(list(vault), [])
+        self.failIf("a" in vault)
+        self.assertRaises(KeyError, vault.__getitem__, "a")
+        self.assertRaises(KeyError, vault.__delitem__, "a")
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_insertion_order(self):
+        vault = self.vault
+        for name in "edcba":
+            vault[name] = dict(tempfile=name)
+        vault["c"] = dict(tempfile="new")
+        del vault["d"]
+        vault["d"] = {}
+        self.assertEqual(list(vault), ["e", "c", "b", "a", "d"])
+        self.assertEqual(len(vault), 5)
+        self.assertEqual(vault["c"], dict(tempfile="new"))
+
+    def test_changes_are_written_back(self):
+        vault = self.vault
+        for name in "abc":
+            vault[name] = dict(tempfile=name)
+        info = vault["a"]
+        info["moved"] = True
+        vault["b"]
+        vault["c"]
+        self.failIf("a" in vault.cache)
+        self.assertEqual(vault["a"], dict(tempfile="a", moved=True))
+        self.failIf(info is vault["b"])
+
+    def test_unchanged_entries_are_not_written_back(self):
+        vault = self.vault
+        stored = []
+        original = vault._store
+        vault._store = lambda path, data: (stored.append(path),
+                                           original(path, data))
+        for name in "abc":
+            vault[name] = dict(tempfile=name)
+        del stored[:]
+        vault["a"]["moved"] = True
+        for name in "bcab":
+            vault[name]
+        self.assertEqual(stored, ["a"])
+        self.assertEqual(vault["a"], dict(tempfile="a", moved=True))
+        self.assertEqual(vault.stored.keys(), vault.cache.keys())
+
+    def test_bounded_cache(self):
+        vault = self.vault
+        for i in range(10):
+            vault[str(i)] = {}
+        self.assertEqual(list(vault.cache), ["8", "9"])
+        self.failUnless("0" in vault)
+
+    def test_clear_removes_database(self):
+        vault = self.vault
+        vault["a"] = {}
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+        vault.clear()
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertEqual(len(vault), 0)
+        vault["b"] = {}
+        self.assertEqual(list(vault), ["b"])
+
+
+class SpillVaultDataManagerTests(FileSafeDataManagerTests):
+
+    def setUp(self):
+        from repoze.filesafe.vault import SpillVault
+        FileSafeDataManagerTests.setUp(self)
+        self.dm.vault = SpillVault(self.tempdir, cache_size=2)
+        self.dm.observed = SpillVault(self.tempdir, cache_size=2)
+
+    def test_vault_cache_size(self):
+        from repoze.filesafe.vault import SpillVault
+
+        class Manager(FileSafeDataManager):
+            vault_cache_size = 10
+        dm = Manager(self.tempdir)
+        self.failUnless(isinstance(dm.vault, SpillVault))
+        self.assertEqual(dm.vault.cache_size, 10)
+        self.failUnless(isinstance(dm.observed, SpillVault))
+
+    def test_conflict_of_spilled_observation(self):
+        from repoze.filesafe.manager import FileConflictError
+        dm = self.dm
+        paths = [os.path.join(self.tempdir, "f%d" % i) for i in range(5)]
+        for path in paths:
+            with open(path, "w") as f:
+                f.write("old")
+            dm.open_file(path).close()
+        self.assertEqual(len(dm.observed.cache), 2)
+        with open(paths[0], "w") as f:
+            f.write("changed")
+        self.assertRaises(FileConflictError, dm.commit, None)
+        dm.tpc_abort(None)
+        self.assertEqual(dm.observed, {})
+
+
+class SizeHintTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "upload")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_preallocate(self):
+        from repoze.filesafe.backends import preallocate
+        with open(self.target, "wb") as f:
+            allocated = preallocate(f.fileno(), 1 << 20)
+            st = os.fstat(f.fileno())
+        self.assertEqual(st.st_size, 0)
+        if allocated:
+            self.failUnless(st.st_blocks * 512 >= 1 << 20)
+
+    def test_preallocate_without_fallocate(self):
+        from repoze.filesafe import backends
+        function = backends._fallocate_function
+        backends._fallocate_function = False
+        try:
+            with open(self.target, "wb") as f:
+                self.assertEqual(backends.preallocate(f.fileno(), 10), False)
+                try:
+                    backends.preallocate(f.fileno(), 1 << 62)
+                except OSError as e:
+                    self.assertEqual(e.errno, errno.ENOSPC)
+                else:  # pragma: no cover
+                    self.fail("No OSError raised")
+        finally:
+            backends._fallocate_function = function
+
+    def test_create_file_with_size_hint(self):
+        dm = self.dm
+        f = dm.create_file(self.target, "wb", size_hint=1000)
+        f.write(b"Hello")
+        f.close()
+        self.assertEqual(dm.reserved, 1000)
+        self.assertEqual(dm.vault[self.target]["size_hint"], 1000)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(open(self.target, "rb").read(), b"Hello")
+        self.assertEqual(dm.reserved, 0)
+
+    def test_no_space(self):
+        dm = self.dm
+        self.assertRaises(OSError, dm.create_file, self.target, "wb",
+                          size_hint=1 << 62)
+        self.failIf(self.target in dm.vault)
+        self.assertEqual(os.listdir(dm.backend.stagedir), [])
+
+    def test_space_budget(self):
+        dm = self.dm
+        dm.space_budget = 100
+        dm.create_file(self.target, "wb", size_hint=60).close()
+        try:
+            dm.create_file(self.target + "2", "wb", size_hint=50)
+        except OSError as e:
+            self.assertEqual(e.errno, errno.ENOSPC)
+        else:  # pragma: no cover
+            self.fail("No OSError raised")
+        dm.create_file(self.target + "3", "wb").close()
+        dm.delete_file(self.target)
+        self.assertEqual(dm.reserved, 0)
+        dm.create_file(self.target + "2", "wb", size_hint=50).close()
+        self.assertEqual(dm.reserved, 50)
+
+
+class FilePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_lazy_open(self):
+        from repoze.filesafe.backends import FilePool
+        from repoze.filesafe.backends import StagedFile
+        pool = FilePool(2)
+        path = os.path.join(self.tempdir, "file")
+        open(path, "w").close()
+        f = StagedFile(path, "w", pool)
+        self.assertEqual(pool.metrics()["open"], 0)
+        f.write("Hello")
+        self.assertEqual(pool.metrics()["open"], 1)
+        f.close()
+        self.assertEqual(pool.metrics()["open"], 0)
+        self.assertEqual(open(path).read(), "Hello")
+        self.assertRaises(ValueError, lambda: f.write("x"))
+
+    def test_budget(self):
+        from repoze.filesafe.backends import FilePool
+        from repoze.filesafe.backends import StagedFile
+        pool = FilePool(2)
+        files = []
+        for i in range(5):
+            path = os.path.join(self.tempdir, "f%d" % i)
+            open(path, "w").close()
+            files.append(StagedFile(path, "wb", pool))
+        for data in [b"Hello", b", ", b"World!"]:
+            for f in files:
+                f.write(data)
+        for f in files:
+            f.close()
+        metrics = pool.metrics()
+        self.assertEqual(metrics["peak"], 2)
+        self.assertEqual(metrics["open"], 0)
+        self.assertEqual(metrics["opens"], 15)
+        self.assertEqual(metrics["evictions"], 13)
+        for f in files:
+            self.assertEqual(open(f.name, "rb").read(), b"Hello, World!")
+
+    def test_commit_releases_preallocation(self):
+        class Manager(FileSafeDataManager):
+            fd_budget = 2
+        target = os.path.join(self.tempdir, "file")
+        for mode in ("wb", "xb"):
+            dm = Manager(self.tempdir)
+            with dm.create_file(target, mode, size_hint=1 << 20) as f:
+                f.write(b"Hello")
+            dm.commit(None)
+            dm.tpc_finish(None)
+            st = os.stat(target)
+            self.assertEqual(st.st_size, 5)
+            self.failUnless(st.st_blocks * 512 < 1 << 20)
+            self.assertEqual(open(target, "rb").read(), b"Hello")
+
+    def test_create_files_with_fd_budget(self):
+        class Manager(FileSafeDataManager):
+            fd_budget = 3
+        dm = Manager(self.tempdir)
+        targets = [os.path.join(self.tempdir, "f%d" % i) for i in range(10)]
+        files = [dm.create_file(target, "w", size_hint=10)
+                 for target in targets]
+        for (target, f) in zip(targets, files):
+            f.write(target)
+        with dm.create_file(targets[0] + "-new", "w") as f:
+            f.write("new")
+        self.failUnless(dm.backend.files.metrics()["open"] <= 3)
+        for f in files:
+            f.close()
+        dm.commit(None)
+        dm.tpc_finish(None)
+        for target in targets:
+            self.assertEqual(open(target).read(), target)
+        self.assertEqual(dm.backend.files.metrics()["open"], 0)
+
+
+class _BudgetDataManager(FileSafeDataManager):
+    fd_budget = 1
+
+
+class FdBudgetDataManagerTests(FileSafeDataManagerTests):
+    DM = _BudgetDataManager
+
+
+class StagingUsageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tempdir, "greeting")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_limits(self):
+        from repoze.filesafe.accounting import StagingUsage
+        parent = StagingUsage(hard_limit=100, file_limit=3)
+        usage = StagingUsage(parent, hard_limit=50)
+        usage.add_file()
+        usage.add_bytes(40)
+        self.assertRaises(OSError, usage.add_bytes, 20)
+        other = StagingUsage(parent)
+        other.add_bytes(60)
+        self.assertRaises(OSError, other.add_bytes, 1)
+        other.add_file()
+        other.add_file()
+        self.assertRaises(OSError, other.add_file)
+        self.assertEqual(parent.metrics(), dict(bytes=100, files=3))
+        usage.release()
+        usage.release()
+        self.assertEqual(parent.metrics(), dict(bytes=60, files=2))
+        usage.add_bytes(1000)
+        self.assertEqual(parent.metrics(), dict(bytes=60, files=2))
+
+    def test_soft_limit_throttles(self):
+        from repoze.filesafe.accounting import StagingUsage
+        usage = StagingUsage(StagingUsage(soft_limit=5), throttle=0.05)
+        usage.add_bytes(5)
+        self.failIf(usage.over_soft_limit())
+        now = time.time()
+        usage.add_bytes(1)
+        self.failUnless(usage.over_soft_limit())
+        self.failUnless(time.time() - now >= 0.05)
+
+    def test_manager_counts_writes(self):
+        from repoze.filesafe.accounting import process_usage
+        before = process_usage.metrics()
+        dm = FileSafeDataManager(self.tempdir)
+        with dm.create_file(self.target, "wb") as f:
+            f.write(b"Hello")
+            f.writelines([b", ", b"World!"])
+        with dm.create_file(self.target + "2", "w") as f:
+            f.write("Hello")
+        self.assertEqual(dm.usage.metrics(), dict(bytes=18, files=2))
+        self.assertEqual(process_usage.bytes, before["bytes"] + 18)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(dm.usage.metrics(), dict(bytes=0, files=0))
+        self.assertEqual(process_usage.metrics(), before)
+        self.assertEqual(open(self.target, "rb").read(), b"Hello, World!")
+
+    def test_text_is_counted_in_bytes(self):
+        dm = FileSafeDataManager(self.tempdir)
+        with dm.create_file(self.target, "w") as f:
+            f.write("caf\xe9")
+        size = len("caf\xe9".encode(f.encoding))
+        self.assertEqual(dm.usage.metrics(), dict(bytes=size, files=1))
+        self.assertEqual(os.path.getsize(f.name), size)
+        dm.tpc_abort(None)
+
+    def test_deleted_files_are_discharged(self):
+        from repoze.filesafe.accounting import process_usage
+        before = process_usage.metrics()
+        dm = FileSafeDataManager(self.tempdir)
+        with dm.create_file(self.target, "wb") as f:
+            f.write(b"Hello, World!")
+        with dm.create_file(self.target + "2", "wb") as f:
+            f.write(b"Hello")
+        dm.delete_file(self.target)
+        self.assertEqual(dm.usage.metrics(), dict(bytes=5, files=1))
+        with dm.create_file(self.target, "wb") as f:
+            f.write(b"Bye")
+        self.assertEqual(dm.usage.metrics(), dict(bytes=8, files=2))
+        self.assertEqual(process_usage.bytes, before["bytes"] + 8)
+        dm.tpc_abort(None)
+        self.assertEqual(process_usage.metrics(), before)
+
+    def test_deleted_files_free_the_file_limit(self):
+        class Manager(FileSafeDataManager):
+            staged_files_limit = 1
+        dm = Manager(self.tempdir)
+        dm.create_file(self.target, "wb").close()
+        dm.delete_file(self.target)
+        dm.create_file(self.target, "wb").close()
+        dm.tpc_abort(None)
+
+    def test_manager_hard_limits(self):
+        class Manager(FileSafeDataManager):
+            staged_bytes_hard_limit = 10
+            staged_files_limit = 2
+        dm = Manager(self.tempdir)
+        f = dm.create_file(self.target, "wb")
+        self.assertRaises(OSError, f.write, b"Hello, World!")
+        f.close()
+        (files, errors) = dm.create_files(
+                [self.target + "2", self.target + "3"], "wb")
+        self.assertEqual(list(files), [self.target + "2"])
+        self.assertEqual(errors[self.target + "3"].errno, errno.ENOSPC)
+        dm.tpc_abort(None)
+
+
+class _DigestDataManager(FileSafeDataManager):
+    digest_algorithm = "sha256"
+
+
+class DigestDataManagerTests(FileSafeDataManagerTests):
+    DM = _DigestDataManager
+
+    def test_digests(self):
+        import hashlib
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        with dm.create_file(target, "wb") as f:
+            f.write(b"Hello, ")
+            f.write(bytearray(b"World!"))
+        with dm.create_file(target + "-text", "w") as f:
+            f.write("Hello, World!")
+        dm.commit(None)
+        expected = hashlib.sha256(b"Hello, World!").hexdigest()
+        self.assertEqual(dm.digests,
+                         {target: expected, target + "-text": expected})
+        self.assertEqual(f.checksum.hexdigest(), expected)
+        dm.tpc_finish(None)
+        self.assertEqual(dm.digests[target], expected)
+
+    def test_expected_digest(self):
+        from repoze.filesafe.manager import FileIntegrityError
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        with dm.create_file(target, "wb", expected_digest="0" * 64) as f:
+            f.write(b"Hello")
+        self.assertRaises(FileIntegrityError, dm.commit, None)
+        dm.tpc_abort(None)
+        self.assertEqual(os.path.exists(target), False)
+        self.assertEqual(dm.digests, {})
+
+    def test_unflushed_data(self):
+        from repoze.filesafe.manager import FileIntegrityError
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        f = dm.create_file(target, "wb")
+        f.write(b"Hello")
+        try:
+            dm.commit(None)
+        except FileIntegrityError as e:
+            self.assertEqual(e.path, target)
+        else:  # pragma: no cover
+            self.fail("No FileIntegrityError raised")
+        f.close()
+        dm.tpc_abort(None)
+
+    def test_writer_which_seeks(self):
+        import hashlib
+        import zipfile
+        dm = self.dm
+        target = os.path.join(self.tempdir, "archive.zip")
+        with dm.create_file(target, "wb") as f:
+            with zipfile.ZipFile(f, "w") as archive:
+                archive.writestr("greeting", "Hello, World!")
+        self.failIf(f.checksum.sequential)
+        dm.commit(None)
+        data = open(target, "rb").read()
+        self.assertEqual(dm.digests[target], hashlib.sha256(data).hexdigest())
+        dm.tpc_finish(None)
+        with zipfile.ZipFile(target) as archive:
+            self.assertEqual(archive.read("greeting"), b"Hello, World!")
+
+    def test_deleted_file_is_not_checked(self):
+        dm = self.dm
+        target = os.path.join(self.tempdir, "greeting")
+        dm.create_file(target, "wb").write(b"Hello")
+        dm.delete_file(target)
+        dm.commit(None)
+        dm.tpc_finish(None)
+        self.assertEqual(dm.digests, {})
+
+
+class ChecksumTests(unittest.TestCase):
+
+    def test_expected_size_without_digest(self):
+        from repoze.filesafe.manager import FileIntegrityError
+        dm = DummyDataManager()
+        with dm.create_file("greeting", "wb", expected_size=10) as f:
+            f.write(b"Hello")
+        self.assertRaises(FileIntegrityError, dm.commit, None)
+        dm.tpc_abort(None)
+
+    def test_expected_size_of_text(self):
+        dm = DummyDataManager()
+        with dm.create_file("greeting", "w", expected_size=2) as f:
+            f.write(u"\xe9")
+        dm.commit(None)
+        dm.tpc_finish(None)
+
+    def test_expected_digest_requires_algorithm(self):
+        dm = DummyDataManager()
+        self.assertRaises(ValueError, dm.create_file, "greeting", "wb",
+                          expected_digest="abc")
+
+    def test_algorithms(self):
+        import zlib
+        from repoze.filesafe.accounting import Checksum
+        checksum = Checksum("crc32")
+        checksum.update(b"Hello, ")
+        checksum.update(b"World!")
+        self.assertEqual(checksum.hexdigest(),
+                         "%08x" % zlib.crc32(b"Hello, World!"))
+        self.assertEqual(checksum.size, 13)
+        self.assertRaises(ValueError, Checksum, "bogus")
+        self.assertEqual(Checksum().hexdigest(), None)
+
+
+def _reject_empty(path, filename):
+    if not os.path.getsize(filename):
+        raise ValueError("empty file")
+
+
+class ValidatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "greeting")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_validators_see_staged_files(self):
+        dm = self.dm
+        seen = []
+
+        def check(path, filename):
+            with open(filename) as f:
+                seen.append((path, f.read()))
+        dm.add_validator(check)
+        with dm.create_file(self.target, "w") as f:
+            f.write("Hello")
+        open(self.target + "-old", "w").close()
+        dm.delete_file(self.target + "-old")
+        dm.commit(None)
+        self.assertEqual(seen, [(self.target, "Hello")])
+        self.assertEqual(list(dm.validation_timings), ["check"])
+        dm.tpc_abort(None)
+
+    def test_validators_see_decompressed_data(self):
+        dm = self.dm
+        seen = []
+
+        def check(path, filename):
+            with open(filename, "rb") as f:
+                seen.append((filename, f.read()))
+        dm.add_validator(check)
+        with dm.create_file(self.target, "w", compress="gzip") as f:
+            f.write("Hello")
+        dm.commit(None)
+        ((filename, data),) = seen
+        self.assertEqual(data, b"Hello")
+        self.assertEqual(os.path.exists(filename), False)
+        dm.tpc_finish(None)
+        with dm.open_file(self.target, "rb", compress="gzip") as f:
+            self.assertEqual(f.read(), b"Hello")
+
+    def test_veto(self):
+        from repoze.filesafe.manager import FileValidationError
+        dm = self.dm
+        dm.add_validator(_reject_empty)
+        dm.create_file(self.target, "w").close()
+        with open(self.target + "-old", "w") as f:
+            f.write("old")
+        dm.rename_file(self.target + "-old", self.target + "-new")
+        try:
+            dm.commit(None)
+        except FileValidationError as e:
+            self.assertEqual(e.path, self.target)
+            self.assertEqual(e.validator, "_reject_empty")
+            self.failUnless(isinstance(e.error, ValueError))
+        else:  # pragma: no cover
+            self.fail("No FileValidationError raised")
+        dm.tpc_abort(None)
+        self.assertEqual(os.path.exists(self.target + "-old"), True)
+        self.assertEqual(os.path.exists(self.target), False)
+
+    def test_class_validators_are_copied(self):
+        class Manager(FileSafeDataManager):
+            validators = (_reject_empty,)
+        dm = Manager(self.tempdir)
+        dm.add_validator(lambda path, filename: None)
+        self.assertEqual(len(dm.validators), 2)
+        self.assertEqual(Manager.validators, (_reject_empty,))
+
+    def test_process_pool(self):
+        import concurrent.futures
+        from repoze.filesafe.manager import FileValidationError
+        dm = self.dm
+        dm.add_validator(_reject_empty)
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            dm.validator_executor = executor
+            with dm.create_file(self.target, "w") as f:
+                f.write("Hello")
+            dm.create_file(self.target + "2", "w").close()
+            self.assertRaises(FileValidationError, dm.commit, None)
+        dm.tpc_abort(None)
+
+
+def _multipart(parts, boundary="xYzZY"):
+    body = []
+    for (name, filename, data) in parts:
+        disposition = 'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += '; filename="%s"' % filename
+        body.append(b"--" + boundary.encode("ascii") + b"\r\n")
+        body.append(("Content-Disposition: %s\r\n" % disposition)
+                    .encode("utf-8"))
+        if filename is not None:
+            body.append(b"Content-Type: application/octet-stream\r\n")
+        body.append(b"\r\n" + data + b"\r\n")
+    body.append(b"--" + boundary.encode("ascii") + b"--\r\n")
+    return b"".join(body)
+
+
+def _upload_environ(body, boundary="xYzZY", length=True):
+    environ = {"REQUEST_METHOD": "POST",
+               "CONTENT_TYPE": "multipart/form-data; boundary=" + boundary,
+               "wsgi.input": io.BytesIO(body)}
+    if length:
+        environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+class ParseMultipartTests(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.filesafe.testing import DummyDataManager
+        self.dm = DummyDataManager()
+
+    def _callFUT(self, environ, destination=None, **kw):
+        from repoze.filesafe.uploads import parse_multipart
+        if destination is None:
+            def destination(name, filename, headers):
+                return "/uploads/" + filename
+        return parse_multipart(environ, destination, self.dm, **kw)
+
+    def test_files_and_fields(self):
+        # Almost, but not quite, the delimiter
+        data = b"\r\n--xYzZ\0" + bytes(range(256)) * 4 + b"\r\n--"
+        body = _multipart([("title", None, b"Hello"),
+                           ("file", "one.bin", data),
+                           ("file", "two.txt", b""),
+                           ("title", None, b"World")])
+        for chunk_size in [1, 7, 64, 1 << 20]:
+            self.dm.tpc_abort(None)
+            (fields, files) = self._callFUT(_upload_environ(body),
+                                            chunk_size=chunk_size)
+            self.assertEqual(fields, {"title": ["Hello", "World"]})
+            self.assertEqual([f.filename for f in files["file"]],
+                             ["one.bin", "two.txt"])
+            self.assertEqual(files["file"][0].size, len(data))
+            self.assertEqual(files["file"][0].content_type,
+                             "application/octet-stream")
+            self.assertEqual(self.dm.open_file("/uploads/one.bin",
+                                               "rb").read(), data)
+            self.assertEqual(self.dm.open_file("/uploads/two.txt",
+                                               "rb").read(), b"")
+
+    def test_without_content_length(self):
+        body = _multipart([("file", "one.bin", b"data")])
+        (fields, files) = self._callFUT(_upload_environ(body, length=False),
+                                        chunk_size=5)
+        self.assertEqual(files["file"][0].size, 4)
+
+    def test_skipped_file(self):
+        body = _multipart([("file", "one.bin", b"data")])
+        (fields, files) = self._callFUT(_upload_environ(body),
+                                        lambda *a: None)
+        self.assertEqual((fields, files), ({}, {}))
+        self.assertEqual(self.dm.data, {})
+
+    def test_invalid_requests(self):
+        from repoze.filesafe.uploads import MultipartError
+        from repoze.filesafe.uploads import unique_destination
+        destination = unique_destination("/uploads")
+        body = _multipart([("file", "one.bin", b"data")])
+        environ = _upload_environ(body)
+        environ["CONTENT_TYPE"] = "text/plain"
+        self.assertRaises(MultipartError, self._callFUT, environ,
+                          destination)
+        environ = _upload_environ(body[:-10])
+        environ["CONTENT_LENGTH"] = str(len(body))
+        self.assertRaises(MultipartError, self._callFUT, environ,
+                          destination)
+        self.assertRaises(MultipartError, self._callFUT,
+                          _upload_environ(body[:-10], length=False),
+                          destination)
+        body = _multipart([("title", None, b"x" * 100)])
+        self.assertRaises(MultipartError, self._callFUT,
+                          _upload_environ(body), max_field_size=50)
+
+    def test_invalid_request_removes_staged_files(self):
+        from repoze.filesafe.uploads import MultipartError
+        body = _multipart([("file", "one.bin", b"data"),
+                           ("file", "two.bin", b"x" * 100)])
+        for chunk_size in [7, 1 << 20]:
+            self.assertRaises(MultipartError, self._callFUT,
+                              _upload_environ(body[:-20]),
+                              chunk_size=chunk_size)
+            self.assertEqual(self.dm.vault, {})
+            self.assertEqual(self.dm.data, {})
+
+    def test_unique_destination(self):
+        from repoze.filesafe.uploads import unique_destination
+        destination = unique_destination("/uploads")
+        path = destination("file", "../../Photo.JPG", None)
+        self.assertEqual(os.path.dirname(path), "/uploads")
+        self.assertTrue(path.endswith(".jpg"))
+        self.assertNotEqual(path, destination("file", "Photo.JPG", None))
+        self.assertFalse("." in destination("file", "x.a/b", None)[9:])
+
+
+class UploadMiddlewareTests(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.filesafe.testing import setup_dummy_data_manager
+        self.dm = setup_dummy_data_manager()
+
+    def tearDown(self):
+        from repoze.filesafe.testing import cleanup_dummy_data_manager
+        cleanup_dummy_data_manager()
+
+    def _makeOne(self, **kw):
+        from repoze.filesafe.middleware import upload_filter_factory
+        self.seen = []
+
+        def app(environ, start_response):
+            self.seen.append((environ.get("repoze.filesafe.uploads"),
+                              environ["CONTENT_TYPE"],
+                              environ["wsgi.input"].read()))
+            start_response("200 OK", [])
+            return [b"ok"]
+        return upload_filter_factory({}, "/uploads", **kw)(app)
+
+    def test_upload(self):
+        middleware = self._makeOne(chunk_size="16")
+        body = _multipart([("title", None, b"Hello & goodbye"),
+                           ("file", "one.txt", b"data")])
+        statuses = []
+        result = middleware(_upload_environ(body),
+                            lambda status, headers: statuses.append(status))
+        self.assertEqual((statuses, result), (["200 OK"], [b"ok"]))
+        ((fields, files), content_type, form) = self.seen[0]
+        self.assertEqual(content_type, "application/x-www-form-urlencoded")
+        self.assertEqual(form, b"title=Hello+%26+goodbye")
+        self.assertEqual(self.dm.open_file(files["file"][0].path, "rb").read(),
+                         b"data")
+
+    def test_bad_request(self):
+        middleware = self._makeOne()
+        body = _multipart([("file", "one.txt", b"data")])
+        statuses = []
+        middleware(_upload_environ(body[:-10]),
+                   lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ["400 Bad Request"])
+        self.assertEqual(self.seen, [])
+        self.assertEqual(self.dm.vault, {})
+
+    def test_other_requests(self):
+        middleware = self._makeOne()
+        environ = _upload_environ(b"a=b")
+        environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+        middleware(environ, lambda status, headers: None)
+        self.assertEqual(self.seen, [(None, environ["CONTENT_TYPE"], b"a=b")])
+
+
+class UploadTransactionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tempdir, "uploads")
+        os.mkdir(self.directory)
+        self.body = _multipart([("file", "one.txt", b"data")])
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, app):
+        from repoze.filesafe.middleware import FileSafeUploadMiddleware
+        from repoze.filesafe.uploads import unique_destination
+        return FileSafeUploadMiddleware(
+                app, unique_destination(self.directory))
+
+    def _call(self, middleware):
+        statuses = []
+        result = middleware(_upload_environ(self.body),
+                            lambda status, headers: statuses.append(status))
+        return (statuses, result)
+
+    def app(self, status):
+        def app(environ, start_response):
+            start_response(status, [])
+            return [b"ok"]
+        return app
+
+    def test_own_transaction(self):
+        middleware = self._makeOne(self.app("200 OK"))
+        self.assertEqual(self._call(middleware), (["200 OK"], [b"ok"]))
+        (name,) = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_own_transaction_error_status(self):
+        middleware = self._makeOne(self.app("500 Internal Server Error"))
+        self._call(middleware)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_inside_transaction_middleware(self):
+        import transaction
+        middleware = self._makeOne(self.app("200 OK"))
+
+        def tm(environ, start_response):
+            environ["repoze.tm.active"] = True
+            transaction.begin()
+            result = middleware(environ, start_response)
+            transaction.commit()
+            return result
+        self.assertEqual(self._call(tm), (["200 OK"], [b"ok"]))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_outside_transaction_middleware(self):
+        import transaction
+        app = self.app("200 OK")
+
+        def tm(environ, start_response):
+            transaction.begin()
+            result = app(environ, start_response)
+            transaction.commit()
+            return result
+        middleware = self._makeOne(tm)
+        self.assertRaises(RuntimeError, self._call, middleware)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dm = FileSafeDataManager(self.tempdir)
+        self.target = os.path.join(self.tempdir, "log.gz")
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def _commit(self, dm):
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+
+    def test_parallel_gzip_members(self):
+        import gzip
+        from repoze.filesafe.compression import CompressingWriter
+        data = b"".join(b"%05d\n" % i for i in range(25000))
+        target = io.BytesIO()
+        target.close = lambda: None
+        writer = CompressingWriter(target, chunk_size=10000, max_pending=2)
+        for i in range(0, len(data), 2500):
+            writer.write(data[i:i + 2500])
+        writer.close()
+        self.assertRaises(ValueError, writer.write, b"more")
+        self.assertEqual(gzip.decompress(target.getvalue()), data)
+        # Every chunk is a separate gzip member.
+        self.assertEqual(target.getvalue().count(b"\x1f\x8b\x08"), 15)
+
+    def test_compressed_text_file(self):
+        import gzip
+        dm = self.dm
+        with dm.create_file(self.target, "w", compress="gzip") as f:
+            f.write("Hello, World!\n" * 1000)
+        self.assertTrue(dm.usage.bytes < 1000)
+        with dm.open_file(self.target) as f:
+            self.assertEqual(f.readline(), "Hello, World!\n")
+        self._commit(dm)
+        with gzip.open(self.target, "rt") as f:
+            self.assertEqual(f.read(), "Hello, World!\n" * 1000)
+        with dm.open_file(self.target, "rb", compress="gzip") as f:
+            self.assertEqual(f.read(14), b"Hello, World!\n")
+        with dm.open_file(self.target, "rb") as f:
+            self.assertEqual(f.read(2), b"\x1f\x8b")
+
+    def test_checksums_cover_compressed_data(self):
+        class Manager(FileSafeDataManager):
+            digest_algorithm = "sha256"
+        dm = Manager(self.tempdir)
+        with dm.create_file(self.target, "wb", compress="gzip") as f:
+            f.write(b"data" * 1000)
+        self._commit(dm)
+        with open(self.target, "rb") as f:
+            self.assertEqual(dm.digests[self.target],
+                             hashlib.sha256(f.read()).hexdigest())
+
+    def test_invalid_options(self):
+        dm = self.dm
+        self.assertRaises(ValueError, dm.create_file, self.target, "w",
+                          compress="lzma")
+        self.assertRaises(ValueError, dm.create_file, self.target, "w+",
+                          compress="gzip")
+        dm.create_file(self.target, "w", compress="gzip").close()
+        self.assertRaises(ValueError, dm.open_file, self.target, "a")
+        dm.tpc_abort(None)
+
+    def test_zstd(self):
+        try:
+            from repoze.filesafe.compression import _zstd
+            _zstd()
+        except ValueError:
+            self.assertRaises(ValueError, self.dm.create_file, self.target,
+                              "wb", compress="zstd")
+            return
+        with self.dm.create_file(self.target, "wb", compress="zstd") as f:
+            f.write(b"data" * 1000)
+        with self.dm.open_file(self.target, "rb") as f:
+            self.assertEqual(f.read(), b"data" * 1000)
+        self.dm.tpc_abort(None)
+
+    def test_memory_backend(self):
+        from repoze.filesafe.testing import DummyDataManager
+        dm = DummyDataManager()
+        with dm.create_file("/log.gz", "w", compress="gzip") as f:
+            f.write("Hello")
+        with dm.open_file("/log.gz") as f:
+            self.assertEqual(f.read(), "Hello")
+        dm.tpc_abort(None)
+
+
+class PlanCommitTests(unittest.TestCase):
+
+    def _callFUT(self, operations):
+        from repoze.filesafe.planner import plan_commit
+        return plan_commit(operations)
+
+    def test_groups_by_directory(self):
+        plan = self._callFUT([("/b/2", {}), ("/a/1", {}), ("/b/1", {}),
+                              ("/a/2", {}), ("/top", {})])
+        self.assertEqual(plan, [("/", ["/top"]), ("/a", ["/a/1", "/a/2"]),
+                                ("/b", ["/b/1", "/b/2"])])
+
+    def test_new_directories_first(self):
+        plan = self._callFUT([("/new/dir/file", {}),
+                              ("/new/dir", {"tree": True}),
+                              ("/new", {"tree": True})])
+        self.assertEqual(plan, [("/", ["/new"]), ("/new", ["/new/dir"]),
+                                ("/new/dir", ["/new/dir/file"])])
+
+    def test_removed_directories_last(self):
+        plan = self._callFUT([
+            ("/old", {"deleted": True, "tree": True}),
+            ("/moved/file", {"source": "/old/file"}),
+            ("/old/file", {"destination": "/moved/file"}),
+            ("/dir", {"source": "/a/b/dir"}),
+            ("/a/b/dir/inside", {})])
+        self.assertEqual(plan, [("/moved", ["/moved/file"]),
+                                ("/old", ["/old/file"]),
+                                ("/", ["/old"]),
+                                ("/a/b/dir", ["/a/b/dir/inside"]),
+                                ("/", ["/dir"])])
+
+    def test_cycles_keep_vault_order(self):
+        plan = self._callFUT([("/p/x", {"source": "/q"}),
+                              ("/q/y", {"source": "/p"}),
+                              ("/c", {})])
+        self.assertEqual(plan, [("/", ["/c"]), ("/p", ["/p/x"]),
+                                ("/q", ["/q/y"])])
+
+
+class LookupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.backend = LocalBackend(self.tempdir)
+        self.scanned = []
+        self._scandir = os.scandir
+
+        def scandir(path):
+            self.scanned.append(path)
+            return self._scandir(path)
+        os.scandir = scandir
+
+    def tearDown(self):
+        os.scandir = self._scandir
+        shutil.rmtree(self.tempdir)
+
+    def paths(self, count):
+        return [os.path.join(self.tempdir, "f%d" % i) for i in range(count)]
+
+    def test_scan_small_directory(self):
+        paths = self.paths(40)
+        open(paths[0], "w").close()
+        found = self.backend.lookup(paths)
+        self.assertEqual(self.scanned, [self.tempdir])
+        self.assertTrue(found[paths[0]] is not None)
+        self.assertEqual(found[paths[1]], None)
+
+    def test_stat_in_large_directory(self):
+        paths = self.paths(2000)
+        for path in paths:
+            open(path, "w").close()
+        found = self.backend.lookup(paths[:10] + [paths[0] + "-missing"])
+        self.assertEqual(self.scanned, [])
+        self.assertTrue(found[paths[9]] is not None)
+        self.assertEqual(found[paths[0] + "-missing"], None)
+
+    def test_commit_does_not_scan(self):
+        dm = FileSafeDataManager(self.tempdir)
+        for path in self.paths(10):
+            dm.create_file(path, "w").close()
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        self.assertEqual(self.scanned, [])
+
+
+class _SyncBackend(LocalBackend):
+
+    def __init__(self, tempdir):
+        LocalBackend.__init__(self, tempdir)
+        self.synced = []
+        self.flushed = []
+
+    def sync_files(self, paths):
+        # Nothing has been moved into place yet
+        self.flushed.extend((path, os.path.exists(path)) for path in paths)
+        LocalBackend.sync_files(self, paths)
+
+    def sync_dirs(self, paths):
+        self.synced.extend(paths)
+        LocalBackend.sync_dirs(self, paths)
+
+
+class CommitPlanDataManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_files_in_new_directory(self):
+        dm = FileSafeDataManager(self.tempdir)
+        target = os.path.join(self.tempdir, "new")
+        with dm.create_file(os.path.join(target, "file"), "w") as f:
+            f.write("Hello")
+        dm.create_dir(target)
+        plan = dm.plan_commit()
+        self.assertEqual([directory for (directory, targets) in plan],
+                         [self.tempdir, target])
+        dm.commit(None)
+        self.assertEqual(dm.commit_plan, plan)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        self.assertEqual(dm.commit_plan, None)
+        with open(os.path.join(target, "file")) as f:
+            self.assertEqual(f.read(), "Hello")
+
+    def test_sync_directories(self):
+        class Manager(FileSafeDataManager):
+            sync_directories = True
+        backend = _SyncBackend(self.tempdir)
+        dm = Manager(self.tempdir, backend)
+        os.mkdir(os.path.join(self.tempdir, "a"))
+        for name in ["a/1", "2", "a/3"]:
+            dm.create_file(os.path.join(self.tempdir, name), "w").close()
+        staging = dm.create_dir(os.path.join(self.tempdir, "tree"))
+        open(os.path.join(staging, "data"), "w").close()
+        dm.commit(None)
+        self.assertEqual(backend.synced,
+                         [self.tempdir, os.path.join(self.tempdir, "a")])
+        self.assertEqual(len(backend.flushed), 4)
+        self.assertEqual(set(exists for (path, exists) in backend.flushed),
+                         set([True]))
+        self.failUnless((staging, True) in backend.flushed)
+        dm.tpc_abort(None)
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "a")), [])
+
+    def test_sync_files(self):
+        backend = LocalBackend(self.tempdir)
+        tree = os.path.join(self.tempdir, "tree")
+        os.makedirs(os.path.join(tree, "sub"))
+        with open(os.path.join(tree, "sub", "data"), "w") as f:
+            f.write("data")
+        os.symlink("missing", os.path.join(tree, "link"))
+        with open(os.path.join(self.tempdir, "file"), "w") as f:
+            f.write("file")
+        backend.sync_files([tree, os.path.join(self.tempdir, "file")])
+
+    def test_abort_undoes_in_reverse_order(self):
+        dm = FileSafeDataManager(self.tempdir)
+        target = os.path.join(self.tempdir, "new")
+        dm.create_dir(target)
+        dm.create_file(os.path.join(target, "file"), "w").close()
+        os.mkdir(os.path.join(self.tempdir, "other"))
+        dm.create_file(os.path.join(self.tempdir, "other"), "w").close()
+        self.assertRaises(OSError, dm.commit, None)
+        dm.tpc_abort(None)
+        wait_for_removals()
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ["other"])
+
+
+class _Span(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.attributes = {}
+        self.failed = False
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.failed = exc_type is not None
+
+
+class _Tracer(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def start_as_current_span(self, name):
+        span = _Span(name)
+        self.spans.append(span)
+        return span
+
+
+class TracingTests(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.filesafe.tracing import set_tracer
+        self.tempdir = tempfile.mkdtemp()
+        self.tracer = _Tracer()
+        set_tracer(self.tracer)
+
+    def tearDown(self):
+        from repoze.filesafe.tracing import set_tracer
+        set_tracer(None)
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def test_spans(self):
+        dm = FileSafeDataManager(self.tempdir)
+        target = os.path.join(self.tempdir, "greeting")
+        with dm.create_file(target, "w", size_hint=5) as f:
+            f.write("Hello")
+        dm.tpc_begin(None)
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        self.assertEqual([span.name for span in self.tracer.spans],
+                         ["filesafe.create_file", "filesafe.tpc_begin",
+                          "filesafe.commit", "filesafe.tpc_vote",
+                          "filesafe.tpc_finish"])
+        (create, begin, commit, vote, finish) = self.tracer.spans
+        self.assertEqual(create.attributes["filesafe.path"], target)
+        self.assertEqual(create.attributes["filesafe.mode"], "w")
+        self.assertEqual(create.attributes["filesafe.size_hint"], 5)
+        self.assertFalse("filesafe.compress" in create.attributes)
+        self.assertEqual(create.attributes["filesafe.vault_size"], 0)
+        self.assertTrue(create.attributes["filesafe.syscalls"] >= 1)
+        self.assertEqual(commit.attributes["filesafe.vault_size"], 1)
+        self.assertEqual(commit.attributes["filesafe.staged_bytes"], 5)
+        self.assertEqual(commit.attributes["filesafe.staged_files"], 1)
+        self.assertTrue(commit.attributes["filesafe.syscalls"] >= 2)
+
+    def test_failed_operation(self):
+        from repoze.filesafe.testing import DummyDataManager
+        dm = DummyDataManager()
+        self.assertRaises(IOError, dm.open_file, "/missing")
+        self.assertEqual(self.tracer.spans[0].name, "filesafe.open_file")
+        self.assertTrue(self.tracer.spans[0].failed)
+
+    def test_disabled(self):
+        from repoze.filesafe.tracing import set_tracer
+        set_tracer(None)
+        dm = FileSafeDataManager(self.tempdir)
+        self.assertTrue(isinstance(dm.backend, LocalBackend))
+        dm.create_file(os.path.join(self.tempdir, "greeting"), "w").close()
+        dm.tpc_abort(None)
+        self.assertEqual(self.tracer.spans, [])
+
+
+class GroupCommitTests(unittest.TestCase):
+
+    def _makeOne(self, window=0.05):
+        from repoze.filesafe.groupcommit import GroupCommit
+        return GroupCommit(window)
+
+    def test_concurrent_syncs_are_shared(self):
+        import threading
+        coordinator = self._makeOne()
+        synced = []
+        barrier = threading.Barrier(5)
+
+        def commit():
+            barrier.wait()
+            coordinator.sync(["/a", "/b"], synced.append)
+        threads = [threading.Thread(target=commit) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(synced), ["/a", "/b"])
+        self.assertEqual(coordinator.metrics(), dict(requests=10, syncs=2))
+        self.assertEqual(coordinator.directories, {})
+
+    def test_sync_waits_for_running_flush(self):
+        import threading
+        coordinator = self._makeOne(0)
+        started = threading.Event()
+        release = threading.Event()
+        synced = []
+
+        def slow(path):
+            started.set()
+            release.wait()
+            synced.append(path)
+        thread = threading.Thread(
+                target=coordinator.sync, args=(["/a"], slow))
+        thread.start()
+        started.wait()
+        # A flush which already started may miss new changes, so a new one
+        # is needed.
+        later = threading.Thread(
+                target=coordinator.sync, args=(["/a"], synced.append))
+        later.start()
+        time.sleep(0.01)
+        self.assertEqual(synced, [])
+        release.set()
+        thread.join()
+        later.join()
+        self.assertEqual(synced, ["/a", "/a"])
+
+    def test_errors_are_raised(self):
+        coordinator = self._makeOne(0)
+
+        def fail(path):
+            raise OSError(errno.EIO, "I/O error")
+        self.assertRaises(OSError, coordinator.sync, ["/a"], fail)
+        self.assertEqual(coordinator.directories, {})
+
+    def test_other_errors_wake_up_waiters(self):
+        import threading
+        coordinator = self._makeOne(0.05)
+        barrier = threading.Barrier(3)
+        errors = []
+
+        def fail(path):
+            raise RuntimeError("broken")
+
+        def commit():
+            barrier.wait()
+            try:
+                coordinator.sync(["/a"], fail)
+            except RuntimeError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=commit) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertEqual(thread.is_alive(), False)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(coordinator.directories, {})
+
+
+class CommitProgressTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "sub"))
+
+    def tearDown(self):
+        wait_for_removals()
+        shutil.rmtree(self.tempdir)
+
+    def _create(self, dm):
+        for (name, data) in [("a", "Hello"), ("sub/b", "World!"),
+                             ("sub/c", "")]:
+            with dm.create_file(os.path.join(self.tempdir, name), "w") as f:
+                f.write(data)
+
+    def test_progress_callbacks(self):
+        progress = []
+        dm = FileSafeDataManager(self.tempdir)
+        dm.add_progress_callback(lambda *a: progress.append(a))
+        self._create(dm)
+        dm.commit(None)
+        self.assertEqual(progress, [(0, 3, 0), (1, 3, 5), (3, 3, 11)])
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+
+    def test_time_budget_exceeded(self):
+        from repoze.filesafe.manager import CommitTimeBudgetExceeded
+        progress = []
+
+        class Manager(FileSafeDataManager):
+            commit_time_budget = 1e-9
+            progress_callbacks = (lambda *a: progress.append(a),)
+        dm = Manager(self.tempdir)
+        self._create(dm)
+        self.assertTrue(dm.estimate_commit_time() > 0)
+        self.assertRaises(CommitTimeBudgetExceeded, dm.commit, None)
+        self.assertEqual(progress, [])
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "a")))
+        dm.tpc_abort(None)
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "sub")), [])
+
+    def test_time_budget(self):
+        class Manager(FileSafeDataManager):
+            commit_time_budget = 60
+        dm = Manager(self.tempdir)
+        self._create(dm)
+        dm.commit(None)
+        dm.tpc_vote(None)
+        dm.tpc_finish(None)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "a")))
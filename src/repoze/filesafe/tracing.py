@@ -0,0 +1,96 @@
+"""Optional tracing of data manager operations.
+
+Tracing is disabled by default. Once a tracer is installed with `set_tracer`
+or `use_opentelemetry`, the file operations and the two-phase commit steps of
+every data manager are wrapped in spans. A tracer only needs the
+``start_as_current_span`` method of OpenTelemetry tracers, so OpenTelemetry
+itself is not required.
+
+Spans are named after the operation, such as ``filesafe.create_file`` or
+``filesafe.commit``, and have these attributes:
+
+``filesafe.<argument>``
+    Arguments of the operation, such as ``filesafe.path``.
+``filesafe.vault_size``
+    The number of entries in the vault when the operation started.
+``filesafe.staged_bytes`` and ``filesafe.staged_files``
+    The data staged by the transaction when the operation started.
+``filesafe.syscalls``
+    The number of storage backend operations, which are mostly single
+    system calls, done by the operation. Only backends of data managers
+    created after the tracer was installed are counted.
+"""
+import functools
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install a tracer, or disable tracing by passing None."""
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def use_opentelemetry(tracer_provider=None):
+    """Trace all operations with OpenTelemetry."""
+    from opentelemetry import trace
+    set_tracer(trace.get_tracer("repoze.filesafe",
+                                tracer_provider=tracer_provider))
+
+
+class CountingBackend(object):
+    """Wrap a storage backend to count the operations done with it."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def __getattr__(self, name):
+        value = getattr(self.backend, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return value(*args, **kwargs)
+        return call
+
+
+def _set(span, name, value):
+    if value is not None:
+        span.set_attribute("filesafe." + name, value)
+
+
+def traced(name, arguments=()):
+    """Decorate a data manager method to run it in a span.
+
+    `arguments` are the names of the leading arguments of the method which
+    are added to the span as attributes.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return method(self, *args, **kwargs)
+            with tracer.start_as_current_span("filesafe." + name) as span:
+                for (argument, value) in zip(arguments, args):
+                    _set(span, argument, value)
+                for argument in arguments[len(args):]:
+                    _set(span, argument, kwargs.get(argument))
+                _set(span, "vault_size", len(self.vault))
+                _set(span, "staged_bytes", self.usage.bytes)
+                _set(span, "staged_files", self.usage.files)
+                backend = self.backend
+                calls = getattr(backend, "calls", None)
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    if calls is not None:
+                        _set(span, "syscalls", backend.calls - calls)
+        return wrapper
+    return decorator
@@ -0,0 +1,228 @@
+"""Stream multipart/form-data uploads straight into staged files.
+
+The request body is read from ``wsgi.input`` in large chunks, and the data of
+every file is written directly to a file created with `create_file`, so
+uploads are neither kept in memory nor copied from another temporary file.
+"""
+import email.message
+import email.utils
+import os.path
+import uuid
+
+
+class MultipartError(ValueError):
+    """The request body is not valid multipart/form-data."""
+
+
+class UploadedFile(object):
+    """A file which was uploaded and staged in the current transaction."""
+
+    def __init__(self, name, filename, content_type, path):
+        #: The name of the form field.
+        self.name = name
+        #: The file name sent by the client. Never use this as a path.
+        self.filename = filename
+        self.content_type = content_type
+        #: The path the file will have once the transaction is committed.
+        self.path = path
+        self.size = 0
+
+    def __repr__(self):
+        return "<UploadedFile %s: %s (%d bytes)>" % (
+                self.name, self.path, self.size)
+
+
+def unique_destination(directory):
+    """Return a destination which stores uploads under random names.
+
+    The extension of the file name sent by the client is kept.
+    """
+    def destination(name, filename, headers):
+        extension = os.path.splitext(filename)[1].lower()
+        if not extension[1:].isalnum():
+            extension = ""
+        return os.path.join(directory, uuid.uuid4().hex + extension)
+    return destination
+
+
+def _boundary(content_type):
+    message = email.message.Message()
+    message["Content-Type"] = content_type or ""
+    if message.get_content_type() != "multipart/form-data":
+        raise MultipartError("Not a multipart/form-data request")
+    boundary = message.get_param("boundary")
+    if not boundary or len(boundary) > 200:
+        raise MultipartError("Missing or invalid multipart boundary")
+    return boundary.encode("latin-1")
+
+
+def _parse_headers(data):
+    message = email.message.Message()
+    for line in data.decode("utf-8", "replace").split("\r\n"):
+        if not line:
+            continue
+        (name, sep, value) = line.partition(":")
+        if not sep:
+            raise MultipartError("Invalid part header %r" % line)
+        message[name.strip()] = value.strip()
+    return message
+
+
+def _param(headers, name):
+    value = headers.get_param(name, header="content-disposition")
+    if value is None:
+        return None
+    return email.utils.collapse_rfc2231_value(value)
+
+
+def _chunks(stream, length, chunk_size):
+    while length is None or length > 0:
+        size = chunk_size if length is None else min(chunk_size, length)
+        data = stream.read(size)
+        if not data:
+            if length is not None:
+                raise MultipartError("Request body is truncated")
+            return
+        if length is not None:
+            length -= len(data)
+        yield data
+
+
+def parse_multipart(environ, destination, manager=None,
+                    chunk_size=1 << 20, max_field_size=1 << 20,
+                    max_header_size=16384):
+    """Parse a multipart/form-data request body.
+
+    For every file in the request `destination` is called with the name of
+    the form field, the file name sent by the client and the headers of the
+    part. It returns the path for the file, or None to skip the file. The
+    data is written to a file created with `create_file` on `manager`, or
+    the data manager for the current transaction.
+
+    Returns a ``(fields, files)`` tuple. `fields` maps the names of normal
+    form fields to lists of values, and `files` maps field names to lists of
+    `UploadedFile` objects. Normal fields are kept in memory, so their total
+    size is limited to `max_field_size` bytes. A `MultipartError` is raised
+    if the request can not be parsed. If parsing fails the files staged so
+    far are deleted again, so a transaction which commits anyway does not
+    store truncated uploads.
+    """
+    if manager is None:
+        from repoze.filesafe import get_manager
+        manager = get_manager()
+    boundary = _boundary(environ.get("CONTENT_TYPE"))
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or -1)
+    except ValueError:
+        raise MultipartError("Invalid Content-Length")
+    if length < 0:
+        length = None
+    stream = environ["wsgi.input"]
+
+    delimiter = b"\r\n--" + boundary
+    keep = len(delimiter) - 1
+    fields = {}
+    files = {}
+    field_size = 0
+    state = "preamble"
+    upload = writer = value = None
+    # Prefix the body with a line break, so the first boundary matches the
+    # delimiter used between parts.
+    buffer = bytearray(b"\r\n")
+
+    def write(size):
+        if writer is not None:
+            with memoryview(buffer) as view:
+                part = view[:size]
+                writer.write(part)
+                part.release()
+            upload.size += size
+        elif value is not None:
+            value.extend(buffer[:size])
+        del buffer[:size]
+
+    try:
+        for chunk in _chunks(stream, length, chunk_size):
+            buffer += chunk
+            while True:
+                if state == "preamble":
+                    index = buffer.find(delimiter)
+                    if index == -1:
+                        del buffer[:-keep]
+                        break
+                    del buffer[:index + len(delimiter)]
+                    state = "boundary"
+                elif state == "boundary":
+                    if len(buffer) < 2:
+                        break
+                    if buffer[:2] == b"--":
+                        state = "end"
+                        break
+                    if buffer[:2] != b"\r\n":
+                        raise MultipartError("Invalid multipart boundary")
+                    del buffer[:2]
+                    state = "headers"
+                elif state == "headers":
+                    index = buffer.find(b"\r\n\r\n")
+                    if index == -1:
+                        if len(buffer) > max_header_size:
+                            raise MultipartError("Part headers are too large")
+                        break
+                    headers = _parse_headers(bytes(buffer[:index]))
+                    del buffer[:index + 4]
+                    name = _param(headers, "name")
+                    filename = _param(headers, "filename")
+                    if name is None:
+                        raise MultipartError("Part without a field name")
+                    if filename is None:
+                        value = bytearray()
+                    else:
+                        path = destination(name, filename, headers)
+                        if path is not None:
+                            upload = UploadedFile(name, filename,
+                                    headers.get_content_type(), path)
+                            writer = manager.create_file(path, "wb")
+                            files.setdefault(name, []).append(upload)
+                    state = "body"
+                elif state == "body":
+                    index = buffer.find(delimiter)
+                    if index == -1:
+                        if len(buffer) > keep:
+                            write(len(buffer) - keep)
+                        if (value is not None and
+                                field_size + len(value) > max_field_size):
+                            raise MultipartError("Form fields are too large")
+                        break
+                    write(index)
+                    del buffer[:len(delimiter)]
+                    if writer is not None:
+                        writer.close()
+                    elif value is not None:
+                        field_size += len(value)
+                        if field_size > max_field_size:
+                            raise MultipartError("Form fields are too large")
+                        fields.setdefault(name, []).append(
+                                value.decode("utf-8", "replace"))
+                    upload = writer = value = None
+                    state = "boundary"
+                else:
+                    break
+            if state == "end":
+                break
+        if state != "end":
+            raise MultipartError("Request body is truncated")
+    except Exception:
+        if writer is not None:
+            writer.close()
+            writer = None
+        for uploads in files.values():
+            for upload in uploads:
+                try:
+                    manager.delete_file(upload.path)
+                except OSError:
+                    pass
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+    return (fields, files)
@@ -0,0 +1,144 @@
+"""An out-of-core vault for transactions with very many files."""
+import collections
+import collections.abc
+import json
+import os
+import sqlite3
+import tempfile
+
+
+class SpillVault(collections.abc.MutableMapping):
+    """A vault which keeps its entries in an sqlite database.
+
+    The data manager keeps an entry for every file it handles in its vault.
+    For transactions with millions of files these take up a lot of memory.
+    This vault stores them in a database file in `directory` instead, and
+    only keeps the `cache_size` most recently used entries in memory. Like a
+    normal dictionary it iterates in insertion order, which is the order in
+    which the data manager commits files. The name of the database file
+    contains the process id, so `filesafe-reap` can remove it if the process
+    dies.
+
+    Entries are dictionaries which the data manager changes in place, so
+    cached entries are written back to the database when they are evicted
+    from the cache, if they were changed since they were stored. The
+    database file is created when the first entry is added, and removed
+    again by `clear`.
+    """
+
+    def __init__(self, directory=None, cache_size=1024, batch_size=1000):
+        self.directory = directory
+        self.cache_size = max(cache_size, 1)
+        self.batch_size = batch_size
+        self.cache = collections.OrderedDict()
+        # The stored form of the cached entries, to find changed entries.
+        self.stored = {}
+        self.path = None
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            (fd, self.path) = tempfile.mkstemp(
+                    dir=self.directory,
+                    prefix="filesafe-vault-%d-" % os.getpid())
+            os.close(fd)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            # The database only has to survive as long as this process.
+            self.db.execute("PRAGMA journal_mode=OFF")
+            self.db.execute("PRAGMA synchronous=OFF")
+            self.db.execute("CREATE TABLE vault ("
+                            "seq INTEGER PRIMARY KEY, "
+                            "path TEXT UNIQUE NOT NULL, "
+                            "info TEXT NOT NULL)")
+        return self.db
+
+    def _store(self, path, data):
+        db = self._connect()
+        if not db.execute("UPDATE vault SET info=? WHERE path=?",
+                          (data, path)).rowcount:
+            db.execute("INSERT INTO vault (path, info) VALUES (?, ?)",
+                       (path, data))
+
+    def _cache(self, path, info, data):
+        cache = self.cache
+        cache[path] = info
+        cache.move_to_end(path)
+        self.stored[path] = data
+        while len(cache) > self.cache_size:
+            (path, info) = cache.popitem(last=False)
+            data = json.dumps(info)
+            if data != self.stored.pop(path):
+                self._store(path, data)
+
+    def __getitem__(self, path):
+        try:
+            info = self.cache[path]
+        except KeyError:
+            pass
+        else:
+            self.cache.move_to_end(path)
+            return info
+        row = None
+        if self.db is not None:
+            row = self.db.execute("SELECT info FROM vault WHERE path=?",
+                                  (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        info = json.loads(row[0])
+        self._cache(path, info, row[0])
+        return info
+
+    def __setitem__(self, path, info):
+        # Store the entry right away, so it gets its place in the commit
+        # order. Changes made through the cache are written back later.
+        data = json.dumps(info)
+        self._store(path, data)
+        self._cache(path, info, data)
+
+    def __delitem__(self, path):
+        cached = self.cache.pop(path, None) is not None
+        self.stored.pop(path, None)
+        deleted = 0
+        if self.db is not None:
+            deleted = self.db.execute("DELETE FROM vault WHERE path=?",
+                                      (path,)).rowcount
+        if not (cached or deleted):
+            raise KeyError(path)
+
+    def __contains__(self, path):
+        if path in self.cache:
+            return True
+        if self.db is None:
+            return False
+        return self.db.execute("SELECT 1 FROM vault WHERE path=?",
+                               (path,)).fetchone() is not None
+
+    def __iter__(self):
+        if self.db is None:
+            return
+        seq = -1
+        while True:
+            rows = self.db.execute("SELECT seq, path FROM vault WHERE seq>? "
+                                   "ORDER BY seq LIMIT ?",
+                                   (seq, self.batch_size)).fetchall()
+            if not rows:
+                return
+            for (seq, path) in rows:
+                yield path
+
+    def __len__(self):
+        if self.db is None:
+            return 0
+        return self.db.execute("SELECT COUNT(*) FROM vault").fetchone()[0]
+
+    def clear(self):
+        self.cache.clear()
+        self.stored.clear()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None